@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+#coding=utf-8
+# stcbench  End-to-end programming benchmark against the stcemu target
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import sys
+import time
+import json
+import random
+import logging
+import platform
+import argparse
+import binascii
+
+import stcflash
+import stcemu
+from stcflash import PROTOSET_8, PROTOSET_15, PROTOSET_PARITY
+
+
+PHASES = ["detect", "handshake", "erase", "flash", "options", "terminate"]
+
+SIZES = [1, 4, 16, 64]
+
+
+# Random image with the given fraction of 128-byte blocks left blank
+def make_image(size, blank=0.0):
+    rnd = random.Random(size)
+    code = bytearray(rnd.getrandbits(8) for i in range(size))
+    for i in range(0, size, 128):
+        if rnd.random() < blank:
+            code[i:i+128] = bytearray([0xFF] * len(code[i:i+128]))
+    return code
+
+
+# Intel HEX text for code, 16 bytes per record, with extended linear
+# address records every 64 KB
+def make_hex(code):
+    lines = []
+    for addr in range(0, len(code), 16):
+        if addr & 0xFFFF == 0:
+            rec = bytearray([2, 0, 0, 4, addr >> 24, (addr >> 16) & 0xFF])
+            rec.append(-sum(rec) & 0xFF)
+            lines.append(b":" + binascii.b2a_hex(bytes(rec)).upper())
+        dat = code[addr:addr+16]
+        if dat == b"\xFF" * len(dat):
+            continue
+        rec = bytearray([len(dat), (addr >> 8) & 0xFF, addr & 0xFF, 0]) + dat
+        rec.append(-sum(rec) & 0xFF)
+        lines.append(b":" + binascii.b2a_hex(bytes(rec)).upper())
+    lines.append(b":00000001FF")
+    return b"\n".join(lines) + b"\n"
+
+
+def bench_hex(size, repeat, blank=0.0):
+    code = make_image(size, blank)
+    text = make_hex(code)
+
+    best = None
+    for i in range(repeat):
+        t = time.time()
+        image = stcflash.parse_hex(text)
+        flat = image.flat()
+        elapsed = time.time() - t
+        best = elapsed if best is None else min(best, elapsed)
+
+    result = {"size": size,
+              "hex_bytes": len(text),
+              "segments": len(image.segments),
+              "seconds": best,
+              "hex_mb_per_second": len(text) / best / 1000000,
+              "ok": (bytes(flat) == bytes(code[:len(flat)])
+                     and code[len(flat):].count(0xFF) == len(code) - len(flat))}
+    sys.stderr.write("hex %9d bytes  %6d segments  %7.3fs  %6.1f MB/s\n"
+                     % (len(text), result["segments"], best,
+                        result["hex_mb_per_second"]))
+    return result
+
+
+def run_phases(prog, code, sparse=False):
+    phases = {}
+
+    def phase(name, func):
+        t = time.time()
+        func()
+        phases[name] = time.time() - t
+
+    def handshake():
+        prog.unknown_packet_1()
+        prog.handshake()
+        prog.unknown_packet_2()
+
+    def flash():
+        for progress in prog.flash(code, sparse):
+            pass
+
+    def options():
+        prog.unknown_packet_3()
+        prog.options()
+
+    phase("detect", prog.detect)
+    phase("handshake", handshake)
+    phase("erase", prog.erase)
+    phase("flash", flash)
+    phase("options", options)
+    phase("terminate", prog.terminate)
+    return phases
+
+
+def bench_one(protocol, size, baud, lowbaud, realtime, blank=0.0,
+              sparse=False):
+    code = make_image(size, blank)
+
+    result = {"protocol": protocol,
+              "size": size,
+              "baud_requested": baud,
+              "realtime": realtime,
+              "blank": blank,
+              "sparse": sparse}
+
+    with stcemu.Target(protocol, realtime=realtime) as target:
+        with target.connect(lowbaud) as conn:
+            prog = stcflash.Programmer(conn, protocol, highbaud=baud)
+            cpu = time.process_time()
+            t = time.time()
+            try:
+                result["phases"] = run_phases(prog, code, sparse)
+            except Exception as e:
+                result["ok"] = False
+                result["error"] = str(e) or e.__class__.__name__
+                return result
+            result["total"] = time.time() - t
+            result["cpu"] = time.process_time() - cpu
+
+        flashed = bytes(target.flash[:len(code)])
+
+    bits = 11 if protocol in PROTOSET_PARITY or protocol in PROTOSET_8 \
+        or protocol in PROTOSET_15 else 10
+    result["ok"] = flashed == bytes(code)
+    result["baud"] = prog.baudrate
+    result["payload_bps"] = size / result["phases"]["flash"]
+    result["line_bps"] = float(prog.baudrate) / bits
+    result["efficiency"] = result["payload_bps"] / result["line_bps"]
+    return result
+
+
+def sweep(protocols, sizes, bauds, lowbaud, realtime, repeat, blank=0.0,
+          sparse=False):
+    results = []
+    for protocol in protocols:
+        romsize = stcemu.TARGETS[protocol]["romsize"] * 1024
+        # Only STC8/STC15 take the requested rate, the others walk their ladder
+        if protocol in PROTOSET_8 or protocol in PROTOSET_15:
+            protobauds = bauds
+        else:
+            protobauds = [max(bauds)]
+        for baud in protobauds:
+            for size in sizes:
+                if size > romsize:
+                    continue
+                for i in range(repeat):
+                    result = bench_one(protocol, size, baud, lowbaud,
+                                       realtime, blank, sparse)
+                    result["run"] = i
+                    report(result)
+                    results.append(result)
+    return results
+
+
+# Connection that acknowledges every frame at once, so that only the host
+# side of the flash loop is measured
+class LoopbackConn:
+    def __init__(self, reply):
+        self.reply = bytes(reply)
+        self.rx = bytearray()
+        self.timeout = None
+        self.parity = None
+        self.baudrate = 115200
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def write(self, s):
+        self.rx += self.reply
+        return len(s)
+
+    def read(self, size=1):
+        s = bytes(self.rx[:size])
+        del self.rx[:size]
+        return s
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        del self.rx[:]
+
+
+def ack_frame(cmd, dat, chkmode):
+    buf = bytearray([0x46, 0xB9, 0x68])
+    n = 1 + 2 + 1 + len(dat) + chkmode + 1
+    buf += bytearray([n >> 8, n & 0xFF, cmd]) + bytearray(dat)
+    chksum = sum(buf[2:])
+    if chkmode > 1:
+        buf.append((chksum >> 8) & 0xFF)
+    buf += bytearray([chksum & 0xFF, 0x16])
+    return buf
+
+
+def bench_host(protocol, size, repeat):
+    code = make_image(size)
+    chkmode = 2 if protocol in PROTOSET_PARITY or protocol in PROTOSET_8 \
+        or protocol in PROTOSET_15 else 1
+
+    conn = LoopbackConn(ack_frame(0x02, [0x54], chkmode))
+    prog = stcflash.Programmer(conn, protocol)
+    prog.chkmode = chkmode
+
+    blocks = 0
+    cpu = time.process_time()
+    t = time.time()
+    for i in range(repeat):
+        for progress in prog.flash(code):
+            blocks += 1
+    elapsed = time.time() - t
+
+    result = {"protocol": protocol,
+              "size": size,
+              "blocks": blocks,
+              "seconds": elapsed,
+              "cpu": time.process_time() - cpu,
+              "us_per_block": elapsed / blocks * 1000000,
+              "ok": True}
+    sys.stderr.write("%-8s %6d  %7d blocks  %8.2f us/block\n"
+                     % (protocol, size, blocks, result["us_per_block"]))
+    return result
+
+
+# Play sessions recorded with "stcflash.py --record" back as fast as
+# possible, which leaves only the host side of the whole protocol
+def bench_replay(path, code, repeat):
+    best = None
+    for i in range(repeat):
+        cpu = time.process_time()
+        t = time.time()
+        r, conn = stcflash.replay_session(path, code)
+        elapsed = time.time() - t
+        cpu = time.process_time() - cpu
+        best = elapsed if best is None else min(best, elapsed)
+        ok = r.ok and conn.error is None and conn.finished()
+        if not ok:
+            break
+
+    result = {"session": path,
+              "size": len(code),
+              "seconds": best,
+              "cpu": cpu,
+              "ok": ok}
+    if not ok:
+        result["error"] = conn.error or r.error or "session not finished"
+    sys.stderr.write("%-30s %6d  %8.3f ms  %s\n"
+                     % (path, len(code), best * 1000,
+                        "ok" if ok else "FAILED " + result["error"]))
+    return result
+
+
+def report(r):
+    if not r["ok"]:
+        sys.stderr.write("%-8s %6d %7d  FAILED %s\n"
+                         % (r["protocol"], r["size"], r["baud_requested"],
+                            r.get("error", "image mismatch")))
+        return
+    sys.stderr.write("%-8s %6d %7d  %s  total %7.3fs  %8.0f B/s (%3.0f%%)\n"
+                     % (r["protocol"], r["size"], r["baud"],
+                        " ".join("%s %6.3f" % (p, r["phases"][p])
+                                 for p in PHASES),
+                        r["total"], r["payload_bps"],
+                        r["efficiency"] * 100))
+
+
+def parse_list(s, kind=str):
+    return [kind(i) for i in s.split(",") if i]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark stcflash against an emulated target.")
+    parser.add_argument("-r", "--protocols",
+                        help="comma separated protocols (default: 8,15,89,12c5a)",
+                        default="8,15,89,12c5a")
+    parser.add_argument("-s", "--sizes",
+                        help="comma separated image sizes in KB (default: %s)"
+                        % ",".join(str(i) for i in SIZES),
+                        default=",".join(str(i) for i in SIZES))
+    parser.add_argument("-b", "--bauds",
+                        help="comma separated high baud rates (default: "
+                        + "460800,115200)",
+                        default="460800,115200")
+    parser.add_argument("-l", "--lowbaud",
+                        help="initial baud rate (default: 2400)",
+                        type=int,
+                        default=2400)
+    parser.add_argument("-n", "--repeat",
+                        help="runs per configuration (default: 1)",
+                        type=int,
+                        default=1)
+    parser.add_argument("-B", "--blank",
+                        help="percentage of 128-byte blocks left blank "
+                        + "(default: 0)",
+                        type=float,
+                        default=0)
+    parser.add_argument("-S", "--sparse",
+                        help="skip blank blocks while flashing",
+                        action="store_true")
+    parser.add_argument("-H", "--host",
+                        help="time only the host side of the flash loop "
+                        + "against an instant loopback connection",
+                        action="store_true")
+    parser.add_argument("-R", "--replay",
+                        help="comma separated sessions recorded with "
+                        + "\"stcflash.py --record\" to replay instead "
+                        + "(needs --image)")
+    parser.add_argument("-i", "--image",
+                        help="code image the sessions were recorded with")
+    parser.add_argument("-x", "--hex",
+                        help="time Intel HEX parsing of images of the given "
+                        + "sizes instead (sizes in KB, e.g. -s 1024,4096)",
+                        action="store_true")
+    parser.add_argument("-f", "--fast",
+                        help="do not pace the target at the line rate "
+                        + "(measures host overhead only)",
+                        action="store_true")
+    parser.add_argument("-o", "--output",
+                        help="write results as JSON to this file "
+                        + "(default: stdout)")
+    parser.add_argument("-v", "--verbose",
+                        help="be verbose",
+                        default=0,
+                        action="count")
+
+    opts = parser.parse_args()
+
+    logging.basicConfig(format=("%(levelname)s: "
+                                + "[%(relativeCreated)d] "
+                                + "%(message)s"),
+                        level=(logging.WARNING,
+                               logging.INFO,
+                               logging.DEBUG)[min(2, opts.verbose)])
+
+    if opts.replay:
+        if not opts.image:
+            parser.error("--replay needs --image")
+        with open(opts.image, "rb") as f:
+            code = stcflash.load_image(f).flat()
+        results = [bench_replay(path, code, max(opts.repeat, 20))
+                   for path in parse_list(opts.replay)]
+    elif opts.hex:
+        results = [bench_hex(size * 1024, max(opts.repeat, 3),
+                             opts.blank / 100.0)
+                   for size in parse_list(opts.sizes, int)]
+    elif opts.host:
+        results = [bench_host(protocol, size * 1024, max(opts.repeat, 20))
+                   for protocol in parse_list(opts.protocols)
+                   for size in parse_list(opts.sizes, int)]
+    else:
+        results = sweep(parse_list(opts.protocols),
+                        [i * 1024 for i in parse_list(opts.sizes, int)],
+                        parse_list(opts.bauds, int),
+                        opts.lowbaud, not opts.fast, opts.repeat,
+                        opts.blank / 100.0, opts.sparse)
+
+    doc = {"python": platform.python_version(),
+           "platform": platform.platform(),
+           "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+           "results": results}
+
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(doc, f, indent=2)
+    else:
+        json.dump(doc, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if not all(r["ok"] for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+#coding=utf-8
+# stcemu  Software STC ISP bootloader for testing stcflash without hardware
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import tty
+import fcntl
+import array
+import select
+import termios
+import logging
+import argparse
+import threading
+import serial
+
+from stcflash import (PROTOCOL_89, PROTOCOL_12C5A, PROTOCOL_12C52,
+                      PROTOCOL_12Cx052, PROTOCOL_8, PROTOCOL_15,
+                      PROTOSET_89, PROTOSET_8, PROTOSET_15, PROTOSET_PARITY)
+
+
+# Default identity of the emulated chip for every protocol family:
+# model bytes, clock in MHz, flash size in KB and version byte/letter
+TARGETS = {
+    PROTOCOL_89:      {"model": (0xF0, 0x02), "fosc": 11.0592, "romsize": 8,
+                       "version": (0x43, ord("C"))},   #STC89C52RC
+    PROTOCOL_12C5A:   {"model": (0xD1, 0x7E), "fosc": 11.0592, "romsize": 60,
+                       "version": (0x62, ord("I"))},   #STC12C5A60S2
+    PROTOCOL_12C52:   {"model": (0xE1, 0x68), "fosc": 11.0592, "romsize": 8,
+                       "version": (0x62, ord("D"))},   #STC12C5208AD
+    PROTOCOL_12Cx052: {"model": (0xF2, 0x14), "fosc": 11.0592, "romsize": 4,
+                       "version": (0x60, ord("A"))},   #STC12C4052AD
+    PROTOCOL_15:      {"model": (0xF5, 0x27), "fosc": 22.1184, "romsize": 48,
+                       "version": (0x72, ord("R"))},   #STC15W4K48S4
+    PROTOCOL_8:       {"model": (0xF7, 0x84), "fosc": 24.0, "romsize": 64,
+                       "version": (0x72, ord("U"))},   #STC8H8K64U
+}
+
+# Latencies used when the target runs in real time
+ERASE_TIME_PER_KB = 0.005
+WRITE_TIME_PER_BLOCK = 0.002
+
+TCGETS2 = 0x802C542A
+
+BAUD_TOLERANCE = 0.03
+
+STATE_DETECT = "detect"
+STATE_SESSION = "session"
+
+
+# Read the line speed the host has configured on the pty
+def line_speed(fd):
+    try:
+        buf = array.array("I", [0] * 11)
+        fcntl.ioctl(fd, TCGETS2, buf)
+        if buf[9]:
+            return buf[9]
+    except (IOError, OSError):
+        pass
+
+    speed = termios.tcgetattr(fd)[4]
+    for name in dir(termios):
+        if name.startswith("B") and name[1:].isdigit():
+            if getattr(termios, name) == speed:
+                return int(name[1:])
+    return 0
+
+
+def same_baud(a, b):
+    return a > 0 and b > 0 and abs(a - b) <= b * BAUD_TOLERANCE
+
+
+# Serial port for the host side of the pty.  A pty has no wire, and some
+# kernels refuse PARENB on it, so the parity setting is kept but not applied.
+class PtySerial(serial.Serial):
+    def _reconfigure_port(self, *args, **kwargs):
+        try:
+            super(PtySerial, self)._reconfigure_port(*args, **kwargs)
+        except (termios.error, serial.SerialException):
+            if self._parity == serial.PARITY_NONE:
+                raise
+            parity = self._parity
+            self._parity = serial.PARITY_NONE
+            try:
+                super(PtySerial, self)._reconfigure_port(*args, **kwargs)
+            finally:
+                self._parity = parity
+
+
+class Target:
+    def __init__(self, protocol, model=None, fosc=None, romsize=None,
+                 version=None, serial_number=None, realtime=False,
+                 erase_time=None, write_time=None, max_baud=None,
+                 write_errors=0, lost_replies=0, reset_at=None):
+        defaults = TARGETS[protocol]
+        self.protocol = protocol
+        self.model = tuple(model or defaults["model"])
+        self.fosc = fosc or defaults["fosc"]
+        self.romsize = romsize or defaults["romsize"]
+        self.version = version or defaults["version"]
+        self.serial_number = bytearray(serial_number or
+                                       [0xF7, 0x8C, 0xC4, 0x06, 0x2A, 0x91, 0x5B])
+        self.realtime = realtime
+        if erase_time is None:
+            erase_time = ERASE_TIME_PER_KB if realtime else 0
+        if write_time is None:
+            write_time = WRITE_TIME_PER_BLOCK if realtime else 0
+        self.erase_time = erase_time
+        self.write_time = write_time
+        # Frames above this rate arrive garbled, like on a poor adapter
+        self.max_baud = max_baud
+        # The first write_errors blocks written get a flipped bit
+        self.write_errors = write_errors
+        # The replies to the first lost_replies blocks written never arrive
+        self.lost_replies = lost_replies
+        # The chip browns out when the block at reset_at is sent
+        self.reset_at = reset_at
+
+        if protocol in PROTOSET_PARITY or protocol in PROTOSET_8 \
+                or protocol in PROTOSET_15:
+            self.chkmode = 2
+        else:
+            self.chkmode = 1
+
+        self.flash = bytearray([0xFF] * (self.romsize * 1024))
+        self.options = None
+        self.sessions = []
+        self.on_terminate = None
+
+        self.master = None
+        self.slave = None
+        self.port = None
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+
+        self.reset()
+
+    # Power cycle the chip: back to the bootloader waiting for 0x7F
+    def reset(self):
+        self.state = STATE_DETECT
+        self.baud0 = None
+        self.baud = None
+        self.rxbuf = bytearray()
+        self.written = set()
+
+    def start(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run,
+                                       name="stcemu %s" % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info("Emulating STC%s target on %s" % (self.protocol, self.port))
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # Open the host side of the emulated port
+    def connect(self, baudrate=2400):
+        return PtySerial(port=self.port, baudrate=baudrate,
+                         parity=serial.PARITY_NONE)
+
+    # Contents of the flash up to the last programmed byte
+    def image(self):
+        end = len(self.flash)
+        while end > 0 and self.flash[end - 1] == 0xFF:
+            end -= 1
+        return bytes(self.flash[:end])
+
+    def run(self):
+        while self.running:
+            r, w, x = select.select([self.master], [], [], 0.05)
+            if not r:
+                continue
+            try:
+                s = os.read(self.master, 4096)
+            except OSError:
+                continue
+            with self.lock:
+                self.receive(bytearray(s))
+
+    def wire_time(self, size, baud):
+        # Even parity is used whenever the checksum is two bytes long
+        bits = 11 if self.chkmode > 1 else 10
+        return float(size * bits) / baud
+
+    def receive(self, s):
+        host = line_speed(self.master)
+        logging.debug("emu recv @%d: %s"
+                      % (host, " ".join(["%02X" % i for i in s])))
+
+        if self.state == STATE_DETECT:
+            if s and not s.strip(b"\x7F"):
+                # The bootloader measures the host baud rate on a run of
+                # 0x7F sync pulses
+                self.baud0 = self.baud = host
+                self.state = STATE_SESSION
+                self.rxbuf = bytearray()
+                self.send_status()
+            return
+
+        if not same_baud(host, self.baud):
+            logging.debug("emu: line at %d bps, target at %d bps"
+                          % (host, self.baud))
+            self.rxbuf = bytearray()
+            return
+
+        if self.max_baud and self.baud > self.max_baud * 1.03:
+            logging.debug("emu: garbled frame at %d bps" % self.baud)
+            self.rxbuf = bytearray()
+            return
+
+        self.rxbuf += s
+        while True:
+            frame = self.parse()
+            if frame is None:
+                break
+            cmd, dat, size = frame
+            if self.realtime:
+                time.sleep(self.wire_time(size, self.baud))
+            self.handle(cmd, dat)
+
+    def parse(self):
+        buf = self.rxbuf
+        start = buf.find(b"\x46\xB9\x6A")
+        if start < 0:
+            del buf[:max(0, len(buf) - 2)]
+            return None
+        del buf[:start]
+        if len(buf) < 5:
+            return None
+
+        n = buf[3] * 256 + buf[4]
+        if n < 5 + self.chkmode or n > 512:
+            del buf[:3]
+            return None
+        if len(buf) < n + 2:
+            return None
+
+        frame = buf[:n + 2]
+        del buf[:n + 2]
+
+        if frame[-1] != 0x16:
+            logging.debug("emu: missing terminal symbol")
+            return None
+        chksum = sum(frame[2:-(1 + self.chkmode)])
+        if self.chkmode > 1:
+            ok = frame[-3] == (chksum >> 8) & 0xFF and frame[-2] == chksum & 0xFF
+        else:
+            ok = frame[-2] == chksum & 0xFF
+        if not ok:
+            logging.debug("emu: incorrect checksum")
+            return None
+
+        return frame[5], frame[6:-(1 + self.chkmode)], len(frame)
+
+    def send(self, cmd, dat, baud=None):
+        buf = bytearray([0x46, 0xB9, 0x68])
+        n = 1 + 2 + 1 + len(dat) + self.chkmode + 1
+        buf += bytearray([n >> 8, n & 0xFF, cmd])
+        buf += bytearray(dat)
+        chksum = sum(buf[2:])
+        if self.chkmode > 1:
+            buf.append((chksum >> 8) & 0xFF)
+        buf += bytearray([chksum & 0xFF, 0x16])
+
+        baud = baud or self.baud
+        # Bytes sent at a rate the host does not listen on are lost
+        deadline = time.time() + 1
+        while not same_baud(line_speed(self.master), baud):
+            if time.time() > deadline:
+                logging.debug("emu: host never switched to %d bps" % baud)
+                return
+            time.sleep(0.001)
+
+        if self.realtime:
+            time.sleep(self.wire_time(len(buf), baud))
+        logging.debug("emu send @%d: %s"
+                      % (baud, " ".join(["%02X" % i for i in buf])))
+        os.write(self.master, bytes(buf))
+
+    # Status packet answered to the 0x7F sync pulses
+    def send_status(self):
+        info = [0xFF] * 32
+        info[0], info[1] = self.version
+        info[2] = 0xFD
+        info[3:5] = self.model
+        info[5] = 0x01
+
+        dat = [0x00] * 16 + info
+        fosc = int(self.fosc * 1000000)
+
+        if self.protocol in PROTOSET_8:
+            dat[0:3] = [(fosc >> 24) & 0xFF, (fosc >> 16) & 0xFF,
+                        (fosc >> 8) & 0xFF]
+            dat[10] = 0xBF
+            dat[22:24] = [36000 >> 8, 36000 & 0xFF]
+            dat[34:36] = [1190 >> 8, 1190 & 0xFF]
+            dat[36:39] = [0x20, 0x05, 0x12]
+        elif self.protocol in PROTOSET_15:
+            dat[0:2] = [36000 >> 8, 36000 & 0xFF]
+            dat[7:10] = [(fosc >> 24) & 0xFF, (fosc >> 16) & 0xFF,
+                         (fosc >> 8) & 0xFF]
+            dat[34:36] = [1187 >> 8, 1187 & 0xFF]
+            dat[41:44] = [0x19, 0x08, 0x26]
+        else:
+            # Eight samples of the 0x7F pulse length in oscillator counts
+            count = int(round(self.fosc * 580974 / self.baud0))
+            for i in range(8):
+                dat[2*i:2*i+2] = [count >> 8, count & 0xFF]
+
+        self.send(0x50, dat)
+
+    def legacy_baud(self, dat):
+        tcfg = dat[0] * 256 + dat[1]
+        if self.protocol in PROTOSET_89:
+            t = 0x10000 - tcfg
+            return self.fosc * 1000000 / 32 / t
+        t = 0x100 - (tcfg & 0xFF)
+        return self.fosc * 1000000 * 2 / 32 / t
+
+    def handle(self, cmd, dat):
+        logging.debug("emu: command %02X" % cmd)
+
+        if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+            self.handle_new(cmd, dat)
+        else:
+            self.handle_legacy(cmd, dat)
+
+    def handle_legacy(self, cmd, dat):
+        if cmd == 0x50:
+            self.send(0x8F, [])
+
+        elif cmd == 0x8F:
+            # Answer at the proposed rate, then fall back to the current one
+            baud = self.legacy_baud(dat)
+            if self.max_baud and baud > self.max_baud * 1.03:
+                logging.debug("emu: garbled test at %d bps" % baud)
+                return
+            self.send(0x8F, [], baud)
+
+        elif cmd == 0x8E:
+            self.baud = self.legacy_baud(dat)
+            self.send(0x8E, [])
+
+        elif cmd == 0x80:
+            self.send(0x80, [])
+
+        elif cmd == 0x69:
+            self.send(0x8D, [])
+
+        elif cmd == 0x84:
+            self.erase()
+            if self.protocol in PROTOSET_89:
+                self.send(0x80, [])
+            else:
+                self.send(0x00, list(self.serial_number))
+
+        elif cmd == 0x00:
+            addr = dat[2] * 256 + dat[3]
+            size = dat[5]
+            if self.fault(addr):
+                return
+            self.write(addr, dat[6:6 + size])
+            if self.reply_lost():
+                return
+            self.send(0x00, [sum(self.flash[addr:addr + size]) & 0xFF])
+
+        elif cmd == 0x8D:
+            self.options = bytes(dat)
+            self.send(0x8D, [])
+
+        elif cmd == 0x82:
+            self.terminate()
+
+        else:
+            logging.debug("emu: unknown command %02X" % cmd)
+
+    def handle_new(self, cmd, dat):
+        if cmd == 0x01:
+            # Reply at the handshake rate, then move to the requested one
+            t1 = dat[2] * 256 + dat[3]
+            base = 24.0 if self.protocol in PROTOSET_8 else 22.1184
+            self.send(0x01, list(dat[:4]))
+            self.baud = base * 1000000 / 4 / (0x10000 - t1)
+
+        elif cmd == 0x05:
+            self.send(0x05, [])
+
+        elif cmd == 0x03:
+            self.erase()
+            self.send(0x03, list(self.serial_number))
+
+        elif cmd in (0x22, 0x02):
+            addr = dat[0] * 256 + dat[1]
+            if self.fault(addr):
+                return
+            ok = self.write(addr, dat[4:])
+            if self.reply_lost():
+                return
+            self.send(0x02, [0x54 if ok else 0x55])
+
+        elif cmd == 0x04:
+            self.options = bytes(dat)
+            self.send(0x04, [0x54])
+
+        elif cmd == 0xFF:
+            self.terminate()
+
+        else:
+            logging.debug("emu: unknown command %02X" % cmd)
+
+    def fault(self, addr):
+        if self.reset_at is None or addr < self.reset_at:
+            return False
+        logging.debug("emu: reset at %04X" % addr)
+        self.reset_at = None
+        self.reset()
+        return True
+
+    def reply_lost(self):
+        if self.lost_replies <= 0:
+            return False
+        self.lost_replies -= 1
+        logging.debug("emu: reply lost")
+        return True
+
+    def erase(self):
+        self.flash[:] = bytearray([0xFF] * len(self.flash))
+        self.written = set()
+        if self.erase_time:
+            time.sleep(self.erase_time * self.romsize)
+
+    def write(self, addr, dat):
+        if addr + len(dat) > len(self.flash):
+            logging.debug("emu: write beyond flash (%04X)" % addr)
+            return False
+        self.flash[addr:addr + len(dat)] = dat
+        self.written.add(addr)
+        if self.write_time:
+            time.sleep(self.write_time)
+        if self.write_errors > 0:
+            self.write_errors -= 1
+            self.flash[addr] ^= 0x01
+            logging.debug("emu: corrupted block %04X" % addr)
+            return False
+        return True
+
+    def terminate(self):
+        session = {"image": self.image(),
+                   "options": self.options,
+                   "baud": self.baud,
+                   "blocks": len(self.written)}
+        self.sessions.append(session)
+        logging.info("Target programmed: %d bytes at %d bps"
+                     % (len(session["image"]), self.baud))
+        self.reset()
+        if self.on_terminate is not None:
+            self.on_terminate(session)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Emulate an STC ISP bootloader on a pseudo terminal.")
+    parser.add_argument("-r", "--protocol",
+                        help="protocol family to emulate (default: 8)",
+                        choices=["89", "12c5a", "12c52", "12cx052", "8", "15"],
+                        default="8")
+    parser.add_argument("-n", "--count",
+                        help="number of targets to create (default: 1)",
+                        type=int,
+                        default=1)
+    parser.add_argument("-o", "--output",
+                        help="write the programmed image to this file")
+    parser.add_argument("-m", "--max-baud",
+                        help="garble frames above this baud rate",
+                        type=int)
+    parser.add_argument("-e", "--write-errors",
+                        help="corrupt this many of the first blocks written",
+                        type=int,
+                        default=0)
+    parser.add_argument("-d", "--lost-replies",
+                        help="drop the replies to this many of the first "
+                        + "blocks written",
+                        type=int,
+                        default=0)
+    parser.add_argument("-R", "--reset-at",
+                        help="reset the chip when the block at this "
+                        + "address is sent, keeping the flash",
+                        type=lambda s: int(s, 0))
+    parser.add_argument("-t", "--realtime",
+                        help="pace replies at the line rate",
+                        action="store_true")
+    parser.add_argument("-v", "--verbose",
+                        help="be verbose",
+                        default=0,
+                        action="count")
+
+    opts = parser.parse_args()
+
+    logging.basicConfig(format=("%(levelname)s: "
+                                + "[%(relativeCreated)d] "
+                                + "%(message)s"),
+                        level=(logging.WARNING,
+                               logging.INFO,
+                               logging.DEBUG)[min(2, opts.verbose)])
+
+    def save(session):
+        if opts.output:
+            with open(opts.output, "wb") as f:
+                f.write(session["image"])
+
+    targets = []
+    for i in range(opts.count):
+        target = Target(opts.protocol, realtime=opts.realtime,
+                        max_baud=opts.max_baud,
+                        write_errors=opts.write_errors,
+                        lost_replies=opts.lost_replies,
+                        reset_at=opts.reset_at)
+        target.on_terminate = save
+        target.start()
+        targets.append(target)
+        print(target.port)
+    sys.stdout.flush()
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for target in targets:
+            target.stop()
+
+
+if __name__ == "__main__":
+    main()
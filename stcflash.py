@@ -24,6 +24,22 @@ import os.path
 import binascii
 import struct
 import argparse
+import glob
+import io
+import threading
+import hashlib
+import json
+import tempfile
+import collections
+import csv
+import mmap
+import asyncio
+import signal
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 PROTOCOL_89 = "89"
@@ -39,484 +55,712 @@ PROTOSET_12B = [PROTOCOL_12C52, PROTOCOL_12Cx052]
 PROTOSET_8 = [PROTOCOL_8]
 PROTOSET_15 = [PROTOCOL_15]
 PROTOSET_PARITY = [PROTOCOL_12C5A, PROTOCOL_12C52]
+# Families whose erase() is known to clear the whole code area to 0xFF, so
+# that blank blocks can be skipped: STC8/STC15 erase everything at once,
+# STC12 as many pages as the flash has.  The STC89 erase takes a count
+# (sent as 1) whose extent is not known, so every block is sent there.
+PROTOSET_SPARSE = [PROTOCOL_12C5A, PROTOCOL_12C52, PROTOCOL_12Cx052,
+                   PROTOCOL_8, PROTOCOL_15]
+
+# Names accepted by --protocol
+PROTOCOL_NAMES = {"89": PROTOCOL_89,
+                  "12c5a": PROTOCOL_12C5A,
+                  "12c52": PROTOCOL_12C52,
+                  "12cx052": PROTOCOL_12Cx052,
+                  "8": PROTOCOL_8,
+                  "15": PROTOCOL_15,
+                  "auto": None}
+
+
+def protocol_name(protocol):
+    for name, value in PROTOCOL_NAMES.items():
+        if value == protocol:
+            return name
+
+BLANK_BLOCK = b"\xFF" * 128
+
+# A block that gets no reply or fails verification is sent again up to
+# this many times, after BLOCK_BACKOFF seconds, doubled on every retry
+BLOCK_RETRIES = 3
+BLOCK_BACKOFF = 0.02
+
+FRAME_SIZE = 256
+
+READ_TIMEOUT = 0.05
+
+# Receive timeouts are the expected answer time of the target, see
+# LatencyModel, times TIMEOUT_MARGIN plus TIMEOUT_SLACK
+TIMEOUT_MARGIN = 2.0
+TIMEOUT_SLACK = 0.02
+
+# Seconds the target takes to act on a command and start to answer (for
+# erase per KB of flash), until measured otherwise
+LATENCY_DEFAULTS = {"reply": 0.1, "write": 0.1, "erase": 0.1}
+
+# Bytes of a typical answer frame
+REPLY_SIZE = 16
+
+# Delays in seconds where there is no condition to wait for instead:
+#   settle     after a frame has left the host, before the line changes
+#              to another baud rate (89/12C series)
+#   retry      after a baud rate the target did not take
+#   terminate  after the termination command has left the host
+#   autoisp    after the reset magic, before detection
+TIMING_DEFAULTS = {"settle": 0.2, "retry": 0.2, "terminate": 0.2,
+                   "autoisp": 0.5}
+
+# Timing profile of each protocol family; the STC8/STC15 bootloaders
+# confirm a new baud rate themselves, so the line need not settle
+TIMING_PROFILES = {"89": dict(TIMING_DEFAULTS),
+                   "12c": dict(TIMING_DEFAULTS),
+                   "15": dict(TIMING_DEFAULTS, settle=0.0),
+                   "8": dict(TIMING_DEFAULTS, settle=0.0)}
+
+# Delays tried by "stcflash.py calibrate", from long to short
+CALIBRATE_STEPS = [0.5, 0.2, 0.1, 0.05, 0.02, 0.01, 0.005, 0.0]
+CALIBRATE_RUNS = 5
+
+DETECT_TIMEOUT = 15.0
+DETECT_MIN_INTERVAL = 0.005
+
+# Seconds between attempts to take a lock held by another port or process
+LOCK_POLL = 0.01
+
+# Seconds between progress events passed on to a callback
+PROGRESS_INTERVAL = 0.1
+
+# Options of a single programming job, as taken by program_device() and
+# by the jobs of the server, with their defaults
+JOB_DEFAULTS = {"lowbaud": 2400,
+                "highbaud": 115200,
+                "protocol": None,
+                "erase_eeprom": None,
+                "sparse": False,
+                "verify": False,
+                "resume": 0,
+                "detect_timeout": DETECT_TIMEOUT,
+                "sync_interval": None,
+                "aispbaud": 4800,
+                "aispmagic": None}
+
+HANDSHAKE_CACHE_SIZE = 256
+
+FLIGHT_RECORDER_SIZE = 2048
+
+# Anyone who can connect can program chips and have files read, so the
+# socket lives in the user's runtime directory and is only open to them
+SERVER_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR")
+                             or tempfile.gettempdir(), "stcflash.sock")
+
+# Rates tried by the STC8/STC15 handshake, below the requested one
+BAUD_LADDER = [460800, 230400, 115200, 57600, 38400, 28800, 19200,
+               14400, 9600, 4800, 2400, 1200]
+
+IMAGE_CACHE_SIZE = 64 * 1024 * 1024
+IMAGE_CACHE_MAGIC = b"STCIMG1\n"
+
+# Builds outgoing frames in one preallocated buffer:
+# 46 B9 6A, length, command, header, payload, checksum, 16
+class FrameEncoder:
+    def __init__(self, size=FRAME_SIZE):
+        self.buf = bytearray(size)
+        self.buf[0:3] = b"\x46\xB9\x6A"
+        self.view = memoryview(self.buf)
+
+    def encode(self, cmd, dat, payload=b"", chkmode=1):
+        n = 1 + 2 + 1 + len(dat) + len(payload) + chkmode + 1
+        if n + 2 > len(self.buf):
+            self.__init__(n + 2)
+
+        buf = self.buf
+        buf[3] = n >> 8
+        buf[4] = n & 0xFF
+        buf[5] = cmd
+        i = 6 + len(dat)
+        buf[6:i] = dat
+        buf[i:i+len(payload)] = payload
+        i += len(payload)
+
+        chksum = sum(self.view[2:i])
+        if chkmode > 1:
+            buf[i] = (chksum >> 8) & 0xFF
+            i += 1
+        buf[i] = chksum & 0xFF
+        buf[i+1] = 0x16
+
+        return self.view[:i+2]
+
+
+# Reassembles incoming frames from whatever the port delivers: start marker,
+# length, command and data, checksum, 16.  Junk before a start marker and
+# broken frames are skipped.
+class FrameParser:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, s):
+        self.buf += s
+
+    def clear(self):
+        del self.buf[:]
+
+    # Drop the start of the current frame to resynchronize
+    def skip(self):
+        del self.buf[:1]
+
+    def pending(self, start):
+        return len(self.buf) > 0 and self.buf.startswith(bytearray(start))
+
+    def next(self, start, chkmode):
+        buf = self.buf
+        marker = bytearray(start)
+        h = len(marker)
+
+        while True:
+            i = buf.find(marker)
+            if i < 0:
+                # Keep what could be the beginning of a start marker
+                del buf[:max(0, len(buf) - h + 1)]
+                return None
+            del buf[:i]
+
+            if len(buf) < h + 2:
+                return None
+            n = buf[h] * 256 + buf[h+1]
+            if n > 64 or n < 5 + chkmode:
+                logging.debug("recv(..): Incorrect packet size")
+                self.skip()
+                continue
 
-class Programmer:
-    def __init__(self, conn, protocol=None):
-        self.conn = conn
-        self.protocol = protocol
-
-        self.conn.timeout = 0.05
-        if self.protocol in PROTOSET_PARITY:
-            self.conn.parity = serial.PARITY_EVEN
-        else:
-            self.conn.parity = serial.PARITY_NONE
-
-        self.chkmode = 0
-
-    def __conn_read(self, size): 
-        buf = bytearray() 
-        while len(buf) < size:
-            s = bytearray(self.conn.read(size - len(buf))) 
-            buf += s
-
-            logging.debug("recv: " + " ".join(["%02X" % i for i in s]))
-
-            if len(s) == 0:
-                raise IOError()
-
-        return list(buf) 
-
-    def __conn_write(self, s):
-        logging.debug("send: " + " ".join(["%02X" % i for i in s]))
-
-        self.conn.write(bytearray(s))
-
-    def __conn_baudrate(self, baud, flush=True):
-        logging.debug("baud: %d" % baud)
-
-        if flush:
-            if self.protocol not in PROTOSET_8 and self.protocol not in PROTOSET_15:
-                self.conn.flush()
-                time.sleep(0.2)
-
-        self.conn.baudrate = baud
-
-    def __model_database(self, model):
-        modelmap = {0xE0: ("12", 1, {(0x00, 0x1F): ("C54", ""),
-                                     (0x60, 0x7F): ("C54", "AD"),
-                                     (0x80, 0x9F): ("LE54", ""),
-                                     (0xE0, 0xFF): ("LE54", "AD"),
-                                     }),
-                    0xE1: ("12", 1, {(0x00, 0x1F): ("C52", ""),
-                                     (0x20, 0x3F): ("C52", "PWM"),
-                                     (0x60, 0x7F): ("C52", "AD"),
-                                     (0x80, 0x9F): ("LE52", ""),
-                                     (0xA0, 0xBF): ("LE52", "PWM"),
-                                     (0xE0, 0xFF): ("LE52", "AD"),
-                                     }),
-                    0xE2: ("11", 1, {(0x00, 0x1F): ("F", ""),
-                                     (0x20, 0x3F): ("F", "E"),
-                                     (0x70, 0x7F): ("F", ""),
-                                     (0x80, 0x9F): ("L", ""),
-                                     (0xA0, 0xBF): ("L", "E"),
-                                     (0xF0, 0xFF): ("L", ""),
-                                     }),
-                    0xE6: ("12", 1, {(0x00, 0x1F): ("C56", ""),
-                                     (0x60, 0x7F): ("C56", "AD"),
-                                     (0x80, 0x9F): ("LE56", ""),
-                                     (0xE0, 0xFF): ("LE56", "AD"),
-                                     }),
-                    0xD1: ("12", 2, {(0x20, 0x3F): ("C5A", "CCP"),
-                                     (0x40, 0x5F): ("C5A", "AD"),
-                                     (0x60, 0x7F): ("C5A", "S2"),
-                                     (0xA0, 0xBF): ("LE5A", "CCP"),
-                                     (0xC0, 0xDF): ("LE5A", "AD"),
-                                     (0xE0, 0xFF): ("LE5A", "S2"),
-                                     }),
-                    0xD2: ("10", 1, {(0x00, 0x0F): ("F", ""),
-                                     (0x60, 0x6F): ("F", "XE"),
-                                     (0x70, 0x7F): ("F", "X"),
-                                     (0xA0, 0xAF): ("L", ""),
-                                     (0xE0, 0xEF): ("L", "XE"),
-                                     (0xF0, 0xFF): ("L", "X"),
-                                     }),
-                    0xD3: ("11", 2, {(0x00, 0x1F): ("F", ""),
-                                     (0x40, 0x5F): ("F", "X"),
-                                     (0x60, 0x7F): ("F", "XE"),
-                                     (0xA0, 0xBF): ("L", ""),
-                                     (0xC0, 0xDF): ("L", "X"),
-                                     (0xE0, 0xFF): ("L", "XE"),
-                                     }),
-                    0xF0: ("89", 4, {(0x00, 0x10): ("C5", "RC"),
-                                     (0x20, 0x30): ("C5", "RC"),  #STC90C5xRC
-                                     }),
-                    0xF1: ("89", 4, {(0x00, 0x10): ("C5", "RD+"),
-                                     (0x20, 0x30): ("C5", "RD+"),  #STC90C5xRD+
-                                     }),
-                    0xF2: ("12", 1, {(0x00, 0x0F): ("C", "052"),
-                                     (0x10, 0x1F): ("C", "052AD"),
-                                     (0x20, 0x2F): ("LE", "052"),
-                                     (0x30, 0x3F): ("LE", "052AD"),
-                                     }),
-                    0xF2A0: ("15W", 1, {(0xA0, 0xA5): ("1", ""),   #STC15W1系列
-                                     }),
-                    0xF400: ("15F", 8, {(0x00, 0x07): ("2K", "S2"),   #STC15F2K系列
-                                     }),
-                    0xF407: ("15F", 60, {(0x07, 0x08): ("2K", "S2"),   #STC15F2K系列
-                                     }),
-                    0xF408: ("15F", 61, {(0x08, 0x09): ("2K", "S2"),   #STC15F2K系列
-                                     }),
-                    0xF400: ("15F", 4, {(0x09, 0x0C): ("4", "AD"),   #STC15FAD系列
-                                     }),
-                    0xF410: ("15F", 8, {(0x10, 0x17): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF417: ("15F", 60, {(0x17, 0x18): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF418: ("15F", 61, {(0x18, 0x19): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF420: ("15F", 8, {(0x20, 0x27): ("1K", "S"),   #STC15F1KS系列
-                                     }),
-                    0xF427: ("15F", 60, {(0x27, 0x28): ("1K", "S"),   #STC15F1KS系列
-                                     }),
-                    0xF440: ("15F", 8, {(0x40, 0x47): ("1K", "S2"),   #STC15F1KS2系列
-                                     }),
-                    0xF447: ("15F", 60, {(0x47, 0x48): ("1K", "S2"),   #STC15F1KS2系列
-                                     }),
-                    0xF448: ("15F", 61, {(0x48, 0x49): ("1K", "S2"),   #STC15F1KS2系列
-                                     }),
-                    0xF44C: ("15F", 13, {(0x4C, 0x4D): ("4", "AD"),  
-                                     }),
-                    0xF450: ("15F", 8, {(0x50, 0x57): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF457: ("15F", 60, {(0x57, 0x58): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF458: ("15F", 61, {(0x58, 0x59): ("1K", "AS"),   #STC15F1KAS系列
-                                     }),
-                    0xF460: ("15F", 8, {(0x60, 0x67): ("1K", "S"),   #STC15F1KS系列
-                                     }),
-                    0xF467: ("15F", 60, {(0x67, 0x68): ("1K", "S"),   #STC15F1KS系列
-                                     }),
-                    0xF468: ("15F", 61, {(0x68, 0x69): ("1K", "S"),   #STC15F1KS系列
-                                     }),
-                    0xF480: ("15L", 8, {(0x80, 0x87): ("2K", "S2"),   #STC15L2KS2系列
-                                     }),
-                    0xF487: ("15L", 60, {(0x87, 0x88): ("2K", "S2"),   #STC15L2KS2系列
-                                     }),
-                    0xF488: ("15L", 61, {(0x88, 0x89): ("2K", "S2"),   #STC15L2KS2系列
-                                     }),
-                    0xF489: ("15L", 5, {(0x89, 0x8C): ("4", "AD"),   #STC15L4AD系列
-                                     }),
-                    0xF490: ("15L", 8, {(0x90, 0x97): ("2K", "AS"),   #STC15L2KAS系列
-                                     }),
-                    0xF497: ("15L", 60, {(0x97, 0x98): ("2K", "AS"),   #STC15L2KAS系列
-                                     }),
-                    0xF498: ("15L", 61, {(0x98, 0x99): ("2K", "AS"),   #STC15L2KAS系列
-                                     }),
-                    0xF4A0: ("15L", 8, {(0xA0, 0xA7): ("2K", "S"),   #STC15L2KS系列
-                                     }),
-                    0xF4A7: ("15L", 60, {(0xA7, 0xA8): ("2K", "S"),   #STC15L2KS系列
-                                     }),
-                    0xF4A8: ("15L", 61, {(0xA8, 0xA9): ("2K", "S"),   #STC15L2KS系列
-                                     }),
-                    0xF4C0: ("15L", 8, {(0xC0, 0xC7): ("1K", "S2"),   #STC15L1KS2系列
-                                     }),
-                    0xF4C7: ("15L", 60, {(0xC7, 0xC8): ("1K", "S2"),   #STC15L1KS2系列
-                                     }),
-                    0xF4C8: ("15L", 61, {(0xC8, 0xC9): ("1K", "S2"),   #STC15L1KS2系列
-                                     }),
-                    0xF4CC: ("15L", 13, {(0xCC, 0xCD): ("4", "AD"),   
-                                     }),
-                    0xF4D0: ("15L", 8, {(0xD0, 0xD7): ("1K", "AS"),   #STC15L1KS2系列
-                                     }),
-                    0xF4D7: ("15L", 60, {(0xD7, 0xD8): ("1K", "AS"),   #STC15L1KS2系列
-                                     }),
-                    0xF4D8: ("15L", 61, {(0xD8, 0xD9): ("1K", "AS"),   #STC15L1KS2系列
-                                     }),
-                    0xF4E0: ("15L", 8, {(0xE0, 0xE7): ("1K", "S"),   #STC15L1KS系列
-                                     }),
-                    0xF4E7: ("15L", 60, {(0xE7, 0xE8): ("1K", "S"),   #STC15L1KS系列
-                                     }),
-                    0xF4E8: ("15L", 61, {(0xE8, 0xE9): ("1K", "S"),   #STC15L1KS系列
-                                     }),
-                    0xF500: ("15W", 1, {(0x00, 0x04): ("1", "SW"),   #STC15W1SW系列
-                                     }),
-                    0xF507: ("15W", 1, {(0x07, 0x0B): ("1", "S"),   #STC15W1S系列
-                                     }),
-                    0xF510: ("15W", 1, {(0x10, 0x14): ("2", "S"),   #STC15W2S系列
-                                     }),
-                    0xF514: ("15W", 8, {(0x14, 0x17): ("1K", "S"),   #STC15W1KS系列
-                                     }),
-                    0xF518: ("15W", 4, {(0x18, 0x1A): ("4", "S"),   #STC15W4S系列
-                                     }),
-                    0xF51A: ("15W", 4, {(0x1A, 0x1C): ("4", "S"),   #STC15W4S系列
-                                     }),
-                    0xF51C: ("15W", 4, {(0x1C, 0x1F): ("4", "AS"),   #STC15W4AS系列
-                                     }),
-                    0xF51F: ("15W", 10, {(0x19, 0x20): ("4", "AS"),   #STC15W4AS系列
-                                     }),
-                    0xF520: ("15W", 12, {(0x20, 0x21): ("4", "AS"),   #STC15W4AS系列
-                                     }),
-                    0xF522: ("15W", 16, {(0x22, 0x23): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF523: ("15W",24, {(0x23, 0x24): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF524: ("15W", 32, {(0x24, 0x25): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF525: ("15W", 40, {(0x25, 0x26): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF526: ("15W", 48, {(0x26, 0x27): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF527: ("15W", 56, {(0x27, 0x28): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF529: ("15W", 1, {(0x29, 0x2B): ("4", "A4"),   #STC15W4AS系列
-                                     }),
-                    0xF52C: ("15W", 8, {(0x2C, 0x2E): ("1K", "PWM"),   #STC15W1KPWM系列
-                                     }),
-                    0xF52E: ("15W", 20, {(0x2E, 0x2F): ("1K", "S"),   #STC15W1KS系列
-                                     }),
-                    0xF52F: ("15W", 32, {(0x2F, 0x30): ("2K", "S2"),   #STC15W2KS2系列
-                                     }),
-                    0xF530: ("15W", 48, {(0x30, 0x31): ("2K", "S2"),   #STC15W2KS2系列
-                                     }),
-                    0xF531: ("15W", 32, {(0x31, 0x32): ("2K", "S2"),   #STC15W2KS2系列
-                                     }),
-                    0xF533: ("15W", 20, {(0x33, 0x34): ("1K", "S2"),   #STC15W1KS2系列
-                                     }),
-                    0xF534: ("15W", 32, {(0x34, 0x35): ("1K", "S2"),   #STC15W1KS2系列
-                                     }),
-                    0xF535: ("15W", 48, {(0x35, 0x36): ("1K", "S2"),   #STC15W1KS2系列
-                                     }),
-                    0xF544: ("15W", 5, {(0x44, 0x45): ("", "SW"),   #STC15SW系列
-                                     }),
-                    0xF554: ("15W", 5, {(0x54, 0x55): ("2", "S"),   #STC15W2S系列
-                                     }),
-                    0xF557: ("15W", 29, {(0x57, 0x58): ("1K", "S"),   #STC15W1KS系列
-                                     }),
-                    0xF55C: ("15W", 13, {(0x5C, 0x5D): ("4", "S"),   #STC15W4S系列
-                                     }),
-                    0xF568: ("15W", 58, {(0x68, 0x69): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF569: ("15W", 61, {(0x69, 0x6A): ("4K", "S4"),   #STC15W4KS4系列
-                                     }),
-                    0xF56C: ("15W", 58, {(0x6C, 0x6D): ("4K", "S4-Student"),   #STC15W4KS4系列
-                                     }),
-                    0xF57E: ("15U", 8, {(0x7E, 0x85): ("4K", "S4"),   #STC15U4KS4系列
-                                     }),
-                    0xF600: ("15H", 8, {(0x00, 0x08): ("4K", "S4"),   #STC154K系列
-                                     }),
-                    0xF620: ("8A", 8, {(0x20, 0x28): ("8K", "S4A12"),   #STC8A8K系列
-                                     }),
-                    0xF628: ("8A", 60, {(0x28, 0x29): ("8K", "S4A12"),   #STC8A8K系列
-                                     }),
-                    0xF630: ("8F", 8, {(0x30, 0x38): ("2K", "S4"),   #STC8F2K系列
-                                     }),
-                    0xF638: ("8F", 60, {(0x38, 0x39): ("2K", "S4"),   #STC8F2K系列
-                                     }),
-                    0xF640: ("8F", 8, {(0x40, 0x48): ("2K", "S2"),   #STC8F2K系列
-                                     }),
-                    0xF648: ("8F", 60, {(0x48, 0x49): ("2K", "S2"),   #STC8F2K系列
-                                     }),
-                    0xF650: ("8A", 8, {(0x50, 0x58): ("4K", "S2A12"),   #STC8A4K系列
-                                     }),
-                    0xF658: ("8A", 60, {(0x58, 0x59): ("4K", "S2A12"),   #STC8A4K系列
-                                     }),
-                    0xF660: ("8F", 2, {(0x60, 0x66): ("1K", "S2"),   #STC8F1K系列
-                                     }),
-                    0xF666: ("8F", 17, {(0x66, 0x67): ("1K", "S2"),   #STC8F1K系列
-                                     }),
-                    0xF670: ("8F", 2, {(0x70, 0x76): ("1K", ""),   #STC8F1K系列
-                                     }),
-                    0xF676: ("8F", 17, {(0x76, 0x77): ("1K", ""),   #STC8F1K系列
-                                     }),
-                    0xF700: ("8C", 2, {(0x00, 0x06): ("1K", ""),   #STC8C系列
-                                     }),   
-                    0xF730: ("8H", 2, {(0x30, 0x36): ("1K", ""),   #STC8H1K系列
-                                     }),
-                    0xF736: ("8H", 17, {(0x36, 0x37): ("1K", ""),   #STC8H1K系列
-                                     }),
-                    0xF740: ("8H", 8, {(0x40, 0x42): ("3K", "S4"),   #STC8H3K系列
-                                     }),
-                    0xF742: ("8H", 60, {(0x42, 0x43): ("3K", "S4"),   #STC8H3K系列
-                                     }),
-                    0xF743: ("8H", 64, {(0x43, 0x44): ("3K", "S4"),   #STC8H3K系列
-                                     }),
-                    0xF748: ("8H", 16, {(0x48, 0x4A): ("3K", "S2"),   #STC8H3K系列
-                                     }),
-                    0xF74A: ("8H", 60, {(0x4A, 0x4B): ("3K", "S2"),   #STC8H3K系列
-                                     }),
-                    0xF74B: ("8H", 64, {(0x4B, 0x4C): ("3K", "S2"),   #STC8H3K系列
-                                     }),
-                    0xF750: ("8G", 2, {(0x50, 0x56): ("1K", "-20/16pin"),   #STC8G1K系列
-                                     }),
-                    0xF756: ("8G", 17, {(0x56, 0x57): ("1K", "-20/16pin"),   #STC8G1K系列
-                                     }),
-                    0xF760: ("8G", 16, {(0x60, 0x62): ("2K", "S4"),   #STC8G2K系列
-                                     }),
-                    0xF762: ("8G", 60, {(0x62, 0x63): ("2K", "S4"),   #STC8G2K系列
-                                     }),
-                    0xF763: ("8G", 64, {(0x63, 0x64): ("2K", "S4"),   #STC8G2K系列
-                                     }),
-                    0xF768: ("8G", 16, {(0x68, 0x6A): ("2K", "S2"),   #STC8G2K系列
-                                     }),
-                    0xF76A: ("8G", 60, {(0x6A, 0x6B): ("2K", "S2"),   #STC8G2K系列
-                                     }),
-                    0xF76B: ("8G", 64, {(0x6B, 0x6C): ("2K", "S2"),   #STC8G2K系列
-                                     }),
-                    0xF770: ("8G", 2, {(0x70, 0x76): ("1K", "T"),   #STC8G2K系列
-                                     }),
-                    0xF776: ("8G", 17, {(0x76, 0x77): ("1K", "T"),   #STC8G2K系列
-                                     }),
-                    0xF780: ("8H", 16, {(0x80, 0x82): ("8K", "U"),   #STC8H8K系列
-                                     }),
-                    0xF782: ("8H", 60, {(0x82, 0x83): ("8K", "U"),   #STC8H8K系列
-                                     }),
-                    0xF783: ("8H", 64, {(0x83, 0x84): ("8K", "U"),   #STC8H8K系列
-                                     }),
-                    0xF790: ("8G", 2, {(0x90, 0x96): ("1K", "A-8PIN"),   #STC8G1K系列
-                                     }),
-                    0xF796: ("8G", 17, {(0x96, 0x97): ("1K", "A-8PIN"),   #STC8G1K系列
-                                     }),
-                    0xF7A0: ("8G", 2, {(0xA0, 0xA6): ("1K", "-8PIN"),   #STC8G1K系列
-                                     }),
-                    0xF7A6: ("8G", 17, {(0xA6, 0xA7): ("1K", "-8PIN"),   #STC8G1K系列
-                                     }),
-                    }
-
-        iapmcu = ((0xD1, 0x3F), (0xD1, 0x5F), (0xD1, 0x7F), (0xF4, 0x4D), (0xF4, 0x99), (0xF4, 0xD9), (0xF5, 0x58), 
-                  (0xD2, 0x7E), (0xD2, 0xFE), (0xF4, 0x09), (0xF4, 0x59), (0xF4, 0xA9), (0xF4, 0xE9), (0xF5, 0x5D), 
-                  (0xD3, 0x5F), (0xD3, 0xDF), (0xF4, 0x19), (0xF4, 0x69), (0xF4, 0xC9), (0xF5, 0x45), (0xF5, 0x62),
-                  (0xE2, 0x76), (0xE2, 0xF6), (0xF4, 0x49), (0xF4, 0x89), (0xF4, 0xCD), (0xF5, 0x55), (0xF5, 0x69),
-                  (0xF5, 0x6A), (0xF5, 0x6D),
-                  )
-
-        try:
-            model = tuple(model) 
-            if self.model[0] in [0xF4, 0xF5, 0xF6, 0xF7]:
-                prefix, romratio, fixmap = modelmap[stc_type_map(model[0],model[1])]
-            elif self.model[0] == 0xF2 and self.model[1] in range(0xA0, 0xA6):
-                prefix, romratio, fixmap = modelmap[stc_type_map(model[0],model[1])]
-                self.protocol = PROTOCOL_15
-            else:
-                prefix, romratio, fixmap = modelmap[model[0]]
-
-            if model[0] in (0xF0, 0xF1) and 0x20 <= model[1] <= 0x30:
-                prefix = "90" 
-
-            for key, value in fixmap.items():
-                if key[0] <= model[1] <= key[1]:
-                    break
-            else:
-                raise KeyError()
-
-            infix, postfix = value
-
-            romsize = romratio * (model[1] - key[0])
-
-            try:
-                romsize = {(0xF0, 0x03): 13}[model]
-            except KeyError:
-                pass
-
-            if model[0] in (0xF0, 0xF1):
-                romfix = str(model[1] - key[0])
-            elif model[0] in (0xF2,):
-                romfix = str(romsize)
-            else:
-                romfix = "%02d" % romsize
-
-            name = "IAP" if model in iapmcu else "STC"
-            name += prefix + infix + romfix + postfix
-            return (name, romsize)
+            end = h + n - 1
+            if len(buf) < end:
+                return None
 
-        except KeyError:
-            return ("Unknown %02X %02X" % model, None)
-
-    def recv(self, timeout = 1, start = [0x46, 0xB9, 0x68]): 
-        timeout += time.time()
+            s = buf[h+2:end]
+            if s[-1] != 0x16:
+                logging.debug("recv(..): Missing terminal symbol")
+                self.skip()
+                continue
 
-        while time.time() < timeout:
-            try:
-                if self.__conn_read(len(start)) == start:                   
-                    break
-            except IOError:
+            chksum = marker[-1] + buf[h] + buf[h+1] + sum(s[:-(1+chkmode)])
+            if chkmode > 0 and chksum & 0xFF != s[-2]:
+                logging.debug("recv(..): Incorrect checksum[0]")
+                self.skip()
                 continue
-        else:
-            logging.debug("recv(..): Timeout")
-            raise IOError()
-
-        chksum = start[-1] 
-
-        s = self.__conn_read(2) 
-        n = s[0] * 256 + s[1] 
-        if n > 64: 
-            logging.debug("recv(..): Incorrect packet size")
-            raise IOError()
-        chksum += sum(s) 
-
-        s = self.__conn_read(n - 3) 
-        if s[n - 4] != 0x16: 
-            logging.debug("recv(..): Missing terminal symbol")
-            raise IOError()
-
-        chksum += sum(s[:-(1+self.chkmode)]) 
-        if self.chkmode > 0 and chksum & 0xFF != s[-2]:
-            logging.debug("recv(..): Incorrect checksum[0]")
-            raise IOError()
-        elif self.chkmode > 1 and (chksum >> 8) & 0xFF != s[-3]:
-            logging.debug("recv(..): Incorrect checksum[1]")
-            raise IOError()
-
-        return (s[0], s[1:-(1+self.chkmode)]) 
-    def first_recv(self, timeout = 1, start = [0x46, 0xB9, 0x68]): 
-        timeout += time.time()
-
-        while time.time() < timeout:
-            try:
-                if self.__conn_read(len(start)) == start:
-                    time.sleep(0.02) #加上20ms延时，增大接收成功率
-                    break
-            except IOError:
+            elif chkmode > 1 and (chksum >> 8) & 0xFF != s[-3]:
+                logging.debug("recv(..): Incorrect checksum[1]")
+                self.skip()
                 continue
-        else:
-            logging.debug("recv(..): Timeout")
-            raise IOError()
-
-        chksum = start[-1]
 
-        s = self.__conn_read(2) 
-        n = s[0] * 256 + s[1] 
-        if n > 64:
-            logging.debug("recv(..): Incorrect packet size")
-            raise IOError()
-        chksum += sum(s) 
+            del buf[:end]
+            return (s[0], list(s[1:-(1+chkmode)]))
+
+
+def hexstr(s):
+    return " ".join(["%02X" % i for i in bytearray(s)])
+
+
+# Keeps the last raw transfers of a session in memory; they are written to
+# a file only if programming fails
+class FlightRecorder:
+    # Written after every session, not only after a failed one
+    always = False
+
+    def __init__(self, directory, name="stcflash", size=FLIGHT_RECORDER_SIZE):
+        self.directory = directory
+        self.name = name
+        self.records = collections.deque(maxlen=size)
+        self.start = time.time()
+        self.header = {}
+
+    def record(self, kind, data):
+        self.records.append((time.time(), kind, bytes(data)))
+
+    def baudrate(self, baud):
+        self.records.append((time.time(), "BAUD", baud))
+
+    def dump(self, error=None):
+        now = time.time()
+        name = "%s-%s-%03d" % (self.name,
+                               time.strftime("%Y%m%d-%H%M%S",
+                                             time.localtime(now)),
+                               int(now * 1000) % 1000)
+        path = os.path.join(self.directory, name + ".trace")
+        n = 1
+        while os.path.exists(path):
+            path = os.path.join(self.directory, "%s-%d.trace" % (name, n))
+            n += 1
+        self.write(path, error)
+        return path
+
+    def write(self, path, error=None):
+        with open(path, "w") as f:
+            for key, value in self.header.items():
+                f.write("# %s %s\n" % (key, value))
+            if error is not None:
+                f.write("# %s\n" % error)
+            for t, kind, data in self.records:
+                if kind == "BAUD":
+                    f.write("%10.6f BAUD %d\n" % (t - self.start, data))
+                else:
+                    f.write("%10.6f %s %s\n" % (t - self.start, kind,
+                                                hexstr(data)))
+
+
+# Records a whole session to path, whether programming succeeds or not,
+# along with the options of the job, for ReplayConn to play back
+class SessionRecorder(FlightRecorder):
+    always = True
+
+    def __init__(self, path, options):
+        FlightRecorder.__init__(self, os.path.dirname(path), size=None)
+        self.path = path
+        self.header = {"options": json.dumps(options, sort_keys=True)}
+
+    def dump(self, error=None):
+        self.write(self.path, error)
+        return self.path
+
+
+def load_session(path):
+    header = {}
+    records = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("# "):
+                key, sep, value = line[2:].partition(" ")
+                header[key] = value
+            elif line:
+                t, kind, data = (line.split(None, 2) + [""])[:3]
+                if kind == "BAUD":
+                    records.append((float(t), kind, int(data)))
+                else:
+                    records.append((float(t), kind,
+                                    bytes(bytearray.fromhex(data))))
+    return header, records
+
+
+# Serial port stand-in that plays a recorded session back.  The host has
+# to write the recorded frames and change to the recorded baud rates, in
+# the same order, and gets the recorded replies, either at once or at the
+# pace they came in.  Sync pulses are matched as a group, since how many
+# were sent depends on when the chip came up.  The first difference is
+# raised as an AssertionError and kept in error, in case the engine took
+# it for a failed exchange.
+class ReplayConn:
+    def __init__(self, path, realtime=False):
+        header, records = load_session(path)
+        self.options = json.loads(header.get("options", "{}"))
+        self.records = []
+        for t, kind, data in records:
+            if kind == "TX" and not data.strip(b"\x7F"):
+                if self.records and self.records[-1][1] == "SYNC":
+                    del self.records[-1]
+                kind = "SYNC"
+            self.records.append((t, kind, data))
+
+        self.realtime = realtime
+        self.port = path
+        self.timeout = None
+        self.parity = serial.PARITY_NONE
+        self.pos = 0
+        self.offset = 0
+        self.sync = False
+        self.rx = collections.deque()
+        self.error = None
+        self.__baudrate = self.options.get("lowbaud", JOB_DEFAULTS["lowbaud"])
+
+    def __at(self, kind):
+        return self.pos < len(self.records) and self.records[self.pos][1] == kind
+
+    def __fail(self, message):
+        if self.error is None:
+            self.error = message
+        raise AssertionError(message)
+
+    def __next(self):
+        # Hand out the replies that followed what the host just did
+        t = self.records[self.pos][0]
+        self.pos += 1
+        now = time.time()
+        while self.__at("RX"):
+            rx_t, kind, data = self.records[self.pos]
+            self.rx.append([now + rx_t - t if self.realtime else now,
+                            bytearray(data)])
+            self.pos += 1
+
+    def finished(self):
+        return self.pos == len(self.records)
+
+    @property
+    def baudrate(self):
+        return self.__baudrate
+
+    @baudrate.setter
+    def baudrate(self, baud):
+        # Baud rate changes outside the engine were not recorded
+        if self.__at("BAUD") and self.records[self.pos][2] == baud:
+            self.__next()
+        self.__baudrate = baud
+
+    @property
+    def in_waiting(self):
+        now = time.time()
+        return sum(len(data) for due, data in self.rx if due <= now)
+
+    @property
+    def out_waiting(self):
+        return 0
+
+    def write(self, s):
+        s = bytes(s)
+        size = len(s)
+        if not s.strip(b"\x7F"):
+            if self.__at("SYNC"):
+                self.sync = True
+                self.__next()
+                return size
+            if self.sync:
+                return size
+        self.sync = False
+
+        while s:
+            if not self.__at("TX"):
+                self.__fail("unexpected write at %d: %s"
+                            % (self.pos, hexstr(s)))
+            data = self.records[self.pos][2]
+            n = min(len(s), len(data) - self.offset)
+            if s[:n] != data[self.offset:self.offset + n]:
+                self.__fail("write at %d: %s, recorded: %s"
+                            % (self.pos, hexstr(s), hexstr(data)))
+            s = s[n:]
+            self.offset += n
+            if self.offset == len(data):
+                self.offset = 0
+                self.__next()
+        return size
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout or 0)
+        while not self.in_waiting:
+            now = time.time()
+            if now >= deadline:
+                return b""
+            due = self.rx[0][0] if self.rx else deadline
+            time.sleep(max(0, min(due, deadline) - now))
+
+        s = bytearray()
+        now = time.time()
+        while self.rx and self.rx[0][0] <= now and len(s) < size:
+            data = self.rx[0][1]
+            n = size - len(s)
+            s += data[:n]
+            del data[:n]
+            if not data:
+                self.rx.popleft()
+        return bytes(s)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        now = time.time()
+        while self.rx and self.rx[0][0] <= now:
+            self.rx.popleft()
+
+    def close(self):
+        pass
+
+
+# Timed spans written in Chrome trace-event format (chrome://tracing or
+# Perfetto); every port gets a track of its own, kept for all the units
+# programmed on it.  Spans go to the file as they end, in the array form
+# that stays readable without the closing bracket, so that a long --loop
+# or serve run keeps nothing in memory.
+class Tracer:
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.file.write("[")
+        self.count = 0
+        self.tracks = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def emit(self, event):
+        with self.lock:
+            self.file.write((",\n" if self.count else "\n")
+                            + json.dumps(event))
+            self.count += 1
+
+    def track(self, name):
+        tid = self.tracks.get(name)
+        if tid is None:
+            tid = self.tracks[name] = len(self.tracks) + 1
+            self.emit({"name": "thread_name", "ph": "M", "pid": 1,
+                       "tid": tid, "args": {"name": name}})
+        return TraceTrack(self, tid)
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class TraceTrack:
+    def __init__(self, tracer, tid):
+        self.tracer = tracer
+        self.tid = tid
+
+    def span(self, name, **args):
+        return TraceSpan(self, name, args)
+
+
+class TraceSpan:
+    def __init__(self, track, name, args):
+        self.track = track
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.begin = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        tracer = self.track.tracer
+        tracer.emit({"name": self.name, "ph": "X", "pid": 1,
+                     "tid": self.track.tid,
+                     "ts": (self.begin - tracer.start) * 1000000,
+                     "dur": (end - self.begin) * 1000000,
+                     "args": self.args})
+        return False
+
+
+# Stands in for the tracer, its tracks and spans when tracing is off
+class NullTracer:
+    def track(self, name):
+        return self
+
+    def span(self, name, **args):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TRACER = NullTracer()
+
+
+def print_device_info(info, out=None):
+    if out is None:
+        out = sys.stdout
+
+    print("系统时钟频率: %.3fMHz" % info["fosc"], file=out)
+    if "wakeup_fosc" in info:
+        print("掉电唤醒定时器频率: %.3fKHz" % info["wakeup_fosc"], file=out)
+        print("内部参考电压: %d mV" % info["internal_vol"], file=out)
+        if "det_low_vol" in info:
+            print("低压检测电压: %.1f V" % info["det_low_vol"], file=out) 
+        print("内部安排测试时间: 20%s年%s月%s日" % tuple(info["test_date"]), file=out)           
+
+    print("单片机型号: %s" % info["model"], file=out)
+    print("固件版本号: %s" % info["version"], file=out)
+    if info["romsize"] is not None:
+        print("程序空间: %dKB" % info["romsize"], file=out)
+
+    if "wdt_prescale" in info:
+        print(" WDT prescal: %d" % info["wdt_prescale"], file=out)
+    for desc, on in info["switches"]:
+        print(" [%c] %s" % ("X" if on else " ", desc), file=out)
+
+
+# The target stopped answering in the middle of flash(), as when it was
+# reset; only then can the download be taken up again by rejoin()
+class SessionLost(IOError):
+    pass
+
 
-        s = self.__conn_read(n - 3) 
-        if s[n - 4] != 0x16: 
-            logging.debug("recv(..): Missing terminal symbol")
-            raise IOError()
+# Protocol engine; every exchange goes through an awaitable transport, so
+# the same code runs on a blocking serial port or in an asyncio event loop
+class AsyncProgrammer:
+    def __init__(self, transport, protocol=None, recorder=None,
+                 highbaud=115200, handshake_cache=None):
+        self.transport = transport
+        self.protocol = protocol
+        self.recorder = recorder
+        self.highbaud = highbaud
+        self.handshake_cache = handshake_cache
 
-        chksum += sum(s[:-(1+self.chkmode)]) 
-        if self.chkmode > 0 and chksum & 0xFF != s[-2]:
-            logging.debug("recv(..): Incorrect checksum[0]")
-            raise IOError()
-        elif self.chkmode > 1 and (chksum >> 8) & 0xFF != s[-3]:
-            logging.debug("recv(..): Incorrect checksum[1]")
-            raise IOError()
+        if self.protocol in PROTOSET_PARITY:
+            self.transport.parity = serial.PARITY_EVEN
+        else:
+            self.transport.parity = serial.PARITY_NONE
 
-        return (s[0], s[1:-(1+self.chkmode)]) 
+        # Line settings to detect the target with, again on a resume
+        self.lowbaud = transport.baudrate
+        self.lowparity = transport.parity
 
-    def send(self, cmd, dat): 
-        buf = [0x46, 0xB9, 0x6A] 
+        self.chkmode = 0
+        self.sent = 0
+        self.sent_at = 0
+        self.encoder = FrameEncoder()
+        self.parser = FrameParser()
+        self.serial_number = None
+        self.fingerprint = None
+        self.romsize = None
+        self.erased = False
+        self.flashed = 0
+        self.resume = 0
+        self.serializer = None
+        self.unit = None
+        self.reset = None
+        self.report = lambda event: None
+        self.detect_timeout = DETECT_TIMEOUT
+        self.sync_interval = None
+        self.detect_time = None
+        self.latency = LatencyModel()
+        self.timing = Timing()
+        self.tracer = NULL_TRACER
+
+    async def __conn_fill(self, timeout=READ_TIMEOUT):
+        # Take whatever is waiting, or wait for one byte up to timeout
+        s = await self.transport.read(timeout)
+
+        if s:
+            if self.recorder is not None:
+                self.recorder.record("RX", s)
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug("recv: " + hexstr(s))
+
+        self.parser.feed(s)
+        return len(s)
+
+    def __conn_flush_input(self):
+        self.transport.flush_input()
+        self.parser.clear()
+
+    async def __conn_write(self, s):
+        if self.recorder is not None:
+            self.recorder.record("TX", s)
+        if logging.root.isEnabledFor(logging.DEBUG):
+            logging.debug("send: " + hexstr(s))
+
+        await self.transport.write(s)
+        self.sent = len(s)
+        self.sent_at = time.time()
+
+    async def __conn_baudrate(self, baud, flush=True):
+        logging.debug("baud: %d", baud)
+        if self.recorder is not None:
+            self.recorder.baudrate(baud)
+
+        with self.tracer.span("baudrate", baud=baud):
+            if flush:
+                await self.transport.drain()
+                await self.__delay("settle")
+
+            self.transport.baudrate = baud
+            self.sent_at = time.time()
+
+    async def __delay(self, name):
+        delay = self.timing.get(self.protocol, name)
+        if delay > 0:
+            with self.tracer.span("wait " + name):
+                await self.transport.sleep(delay)
 
-        n = 1 + 2 + 1 + len(dat) + self.chkmode + 1 
-        buf += [n >> 8, n & 0xFF, cmd] 
+    def __model_database(self, model):
+        if model[0] == 0xF2 and model[1] in range(0xA0, 0xA6):
+            self.protocol = PROTOCOL_15
+
+        return lookup_model(model[0], model[1])
+
+    def __wire_time(self, size):
+        bits = 10 if self.transport.parity == serial.PARITY_NONE else 11
+        return float(size * bits) / self.transport.baudrate
+
+    # Without an explicit timeout, wait as long as the latency model says
+    # the answer to the last command (of the given kind) may take
+    async def recv(self, timeout=None, start=[0x46, 0xB9, 0x68],
+                   kind="reply"):
+        with self.tracer.span("recv"):
+            model = timeout is None
+            if model:
+                wire = self.__wire_time(self.sent + REPLY_SIZE)
+                timeout = self.latency.timeout(kind, wire, self.romsize)
+            deadline = self.sent_at + timeout if model else time.time() + timeout
+
+            while True:
+                frame = self.parser.next(start, self.chkmode)
+                if frame is not None:
+                    if model:
+                        self.latency.observe(kind,
+                                             time.time() - self.sent_at - wire,
+                                             self.romsize)
+                    return frame
+
+                pending = self.parser.pending(start)
+                if not pending and time.time() >= deadline:
+                    logging.debug("recv(..): Timeout (%.3fs)" % timeout)
+                    raise IOError()
+
+                # Idle, wait no longer than the deadline
+                wait = READ_TIMEOUT
+                if not pending:
+                    wait = min(wait, max(0.001, deadline - time.time()))
+                if await self.__conn_fill(wait) == 0 and pending:
+                    # The line went quiet in the middle of a frame
+                    logging.debug("recv(..): Incomplete packet")
+                    self.parser.skip()
+                    raise IOError()
+
+    async def send(self, cmd, dat, payload=b""): 
+        await self.__conn_write(self.encoder.encode(cmd, dat, payload, self.chkmode))
+
+    async def detect(self):
+        if self.protocol in [PROTOCOL_89,PROTOCOL_12C52,PROTOCOL_12Cx052,PROTOCOL_12C5A]:
+            pulse = b"\x7F\x7F"
+        else:
+            pulse = b"\x7F"
+
+        interval = self.sync_interval
+        if interval is None:
+            # Leave the line idle about as long as a pulse takes on the wire
+            bits = 10 if self.transport.parity == serial.PARITY_NONE else 11
+            interval = max(DETECT_MIN_INTERVAL,
+                           2.0 * len(pulse) * bits / self.transport.baudrate)
+
+        time_start = time.time()
+        deadline = time_start + self.detect_timeout
+        next_pulse = time_start
+        while True:
+            frame = self.parser.next([0x68], self.chkmode)
+            if frame is not None:
+                cmd, dat = frame
+                break
 
-        buf += dat  
+            if self.parser.pending([0x68]):
+                try:
+                    cmd, dat = await self.recv(0, [0x68])
+                    break
+                except IOError:
+                    continue
 
-        chksum = sum(buf[2:]) 
-        if self.chkmode > 1:
-            buf += [(chksum >> 8) & 0xFF] 
-        buf += [chksum & 0xFF, 0x16] 
+            now = time.time()
+            if now >= deadline:
+                raise IOError()
+            if now >= next_pulse:
+                await self.__conn_write(pulse)
+                next_pulse = now + interval
+            # Wait at most until the next pulse is due; this returns as
+            # soon as the first byte of the status packet arrives
+            await self.__conn_fill(interval)
 
-        self.__conn_write(buf)
+        self.detect_time = time.time() - time_start
+        logging.info("Target detected in %.3fs" % self.detect_time)
 
-    def detect(self):  
-       
-        for i in range(500): 
-            try:
-                if self.protocol in [PROTOCOL_89,PROTOCOL_12C52,PROTOCOL_12Cx052,PROTOCOL_12C5A]:
-                    self.__conn_write([0x7F,0x7F])
-                    cmd, dat = self.first_recv(0.03, [0x68]) 
-                else:
-                    self.__conn_write([0x7F])  
-                    cmd, dat = self.first_recv(0.03, [0x68]) 
-                break
-            except IOError:
-                pass
-        else:
-            raise IOError()       
-        
-        
         self.info = dat[16:]
 
         self.version = "%d.%d%c" % (self.info[0] >> 4,
@@ -534,19 +778,7 @@ class Programmer:
         
         if self.protocol is None:
             try:
-                self.protocol = {0xF0: PROTOCOL_89,       #STC89/90C5xRC
-                                 0xF1: PROTOCOL_89,       #STC89/90C5xRD+
-                                 0xF2: PROTOCOL_12Cx052,  #STC12Cx052
-                                 0xD1: PROTOCOL_12C5A,    #STC12C5Ax
-                                 0xD2: PROTOCOL_12C5A,    #STC10Fx
-                                 0xE1: PROTOCOL_12C52,    #STC12C52x
-                                 0xE2: PROTOCOL_12C5A,    #STC11Fx
-                                 0xE6: PROTOCOL_12C52,    #STC12C56x
-                                 0xF4: PROTOCOL_15,    #STC15系列
-                                 0xF5: PROTOCOL_15,    #STC15系列
-                                 0xF6: PROTOCOL_8,  #STC8系列
-                                 0xF7: PROTOCOL_8,  #STC8系列
-                                 }[self.model[0]]
+                self.protocol = MODEL_PROTOCOLS[self.model[0]]
             except KeyError:
                 pass
 
@@ -565,6 +797,8 @@ class Programmer:
                 self.det_low_vol = 2.2
             else:
                 self.det_low_vol = (191 - dat[10])*0.3 + 2.1    
+            # Factory data (calibration, test date) used to recognise the chip
+            self.fingerprint = self.model + dat[10:11] + dat[22:24] + dat[34:39]
 
         elif self.protocol in PROTOSET_15:
             self.fosc = (dat[7]*0x1000000 +dat[8]*0x10000+dat[9]*0x100) /1000000 
@@ -577,17 +811,18 @@ class Programmer:
                                         self.info[0] & 0x0F,
                                         self.info[5],
                                         self.info[1])   
+            self.fingerprint = self.model + dat[0:2] + dat[34:36] + dat[41:44]
             
         else:
             self.fosc = (float(sum(dat[0:16:2]) * 256 + sum(dat[1:16:2])) / 8
-                     * self.conn.baudrate / 580974)
+                     * self.transport.baudrate / 580974)
 
         if self.protocol in PROTOSET_PARITY or self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15: 
             self.chkmode = 2
-            self.conn.parity = serial.PARITY_EVEN
+            self.transport.parity = serial.PARITY_EVEN
         else:
             self.chkmode = 1
-            self.conn.parity = serial.PARITY_NONE
+            self.transport.parity = serial.PARITY_NONE
 
         if self.protocol is not None:
             del self.info[-self.chkmode:]
@@ -597,29 +832,28 @@ class Programmer:
             logging.info("UART Parity: %s"
                          % {serial.PARITY_NONE: "NONE",
                             serial.PARITY_EVEN: "EVEN",
-                            }[self.conn.parity])
+                            }[self.transport.parity])
 
         for i in range(0, len(self.info), 16):
             logging.info("Info string [%d]: %s"
                          % (i // 16,
                             " ".join(["%02X" % j for j in self.info[i:i+16]])))
-    def print_info(self):
-        print("系统时钟频率: %.3fMHz" % self.fosc)
-        if self.protocol in PROTOSET_8:
-            print("掉电唤醒定时器频率: %.3fKHz" % self.wakeup_fosc)
-            print("内部参考电压: %d mV" %self.internal_vol)
-            print("低压检测电压: %.1f V" %self.det_low_vol) 
-            print("内部安排测试时间: 20%s年%s月%s日" %(self.test_year,self.test_month,self.test_day))           
+    # Everything known about the target after detect()
+    def device_info(self):
+        info = {"model": self.name,
+                "protocol": self.protocol,
+                "version": self.version,
+                "romsize": self.romsize,
+                "fosc": self.fosc,
+                "detect_time": self.detect_time}
 
-        if self.protocol in PROTOSET_15:
-            print("掉电唤醒定时器频率: %.3fKHz" % self.wakeup_fosc)
-            print("内部参考电压: %d mV" %self.internal_vol) 
-            print("内部安排测试时间: 20%s年%s月%s日" %(self.test_year,self.test_month,self.test_day))   
-
-        print("单片机型号: %s" % self.name)
-        print("固件版本号: %s" % self.version)
-        if self.romsize is not None:
-            print("程序空间: %dKB" % self.romsize)
+        if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+            info["wakeup_fosc"] = self.wakeup_fosc
+            info["internal_vol"] = self.internal_vol
+            info["test_date"] = [self.test_year, self.test_month,
+                                 self.test_day]
+        if self.protocol in PROTOSET_8:
+            info["det_low_vol"] = self.det_low_vol
 
         if self.protocol == PROTOCOL_89:
             switches = [( 2, 0x80, "Reset stops                                                                                                  "),
@@ -640,7 +874,7 @@ class Programmer:
                         ( 8, 0x04, "WDT count in idle mode"),
                         (10, 0x02, "Not erase data EEPROM"),
                         (10, 0x01, "Download regardless of P1")]
-            print(" WDT prescal: %d" % 2**((self.info[8] & 0x07) + 1))
+            info["wdt_prescale"] = 2**((self.info[8] & 0x07) + 1)
 
         elif self.protocol in PROTOSET_12B:
             switches = [(8, 0x02, "Not erase data EEPROM")]
@@ -648,121 +882,142 @@ class Programmer:
         else:
             switches = []
 
-        for pos, bit, desc in switches:
-            print(" [%c] %s" % ("X" if self.info[pos] & bit else " ", desc))
-
-    def handshake(self):
-        baud0 = self.conn.baudrate
+        info["switches"] = [(desc, bool(self.info[pos] & bit))
+                            for pos, bit, desc in switches]
+        return info
+
+    def print_info(self, out=None):
+        print_device_info(self.device_info(), out)
+
+    def __baudstr_8(self, baud):
+        #定时器1重载值计算微调，可能由于目标芯片的差异性需要微调
+        if baud in [300000,350000]:
+            Timer1_value = int(65536.2 - float(24.0 * 1000000 / 4 / baud))  
+        else: 
+            Timer1_value = int(65536.5 - float(24.0 * 1000000 / 4 / baud))  
+
+        if self.fosc < 24.5 and self.fosc > 23.5:    #24M
+            foc_value = 0x7B
+        elif self.fosc < 27.5 and self.fosc > 26.5:  #27M
+            foc_value = 0xB0
+        elif self.fosc < 22.7 and self.fosc > 21.7:  #22.1184M
+            foc_value = 0x5A
+        elif self.fosc < 20.5 and self.fosc > 19.5:  #20M
+            foc_value = 0x35
+        elif self.fosc < 12.3 and self.fosc > 11.7:  #12M
+            foc_value = 0x7B
+        elif self.fosc < 11.4 and self.fosc > 10.8:  #11.0592M
+            foc_value = 0x5A
+        elif self.fosc < 18.8 and self.fosc > 18.0:  #18.432M
+            foc_value = 0x1A
+        elif self.fosc < 6.3 and self.fosc > 5.7:#6M
+            foc_value = 0x12
+        elif self.fosc < 5.9 and self.fosc > 5.0:  #5.5296M
+            foc_value = 0x5A
+        else:
+            foc_value = 0x6B
+                      
+        return [0x00, 0x00, Timer1_value >> 8, Timer1_value & 0xff, 0x01, foc_value, 0x81]
+
+    def __baudstr_15(self, baud):
+        #定时器1重载值计算微调，可能由于目标芯片的差异性需要微调
+        if baud in [300000,350000]:
+            Timer1_value = int(65536.2 - float(22.1184 * 1000000 / 4 / baud))  
+        else: 
+            Timer1_value = int(65536.5 - float(22.1184 * 1000000 / 4 / baud))  
+
+        if self.fosc < 24.5 and self.fosc > 23.5:    #24M
+            foc_value_1 = 0x40
+            foc_value_2 = 0x9F
+        elif self.fosc < 27.5 and self.fosc > 26.5:  #27M
+            foc_value_1 = 0x40
+            foc_value_2 = 0xDC
+        elif self.fosc < 22.7 and self.fosc > 21.7:  #22.1184M
+            foc_value_1 = 0x40
+            foc_value_2 = 0x79
+        elif self.fosc < 20.5 and self.fosc > 19.5:  #20M
+            foc_value_1 = 0x40
+            foc_value_2 = 0x4F
+        elif self.fosc < 12.3 and self.fosc > 11.7:  #12M
+            foc_value_1 = 0x80
+            foc_value_2 = 0xA2
+        elif self.fosc < 11.4 and self.fosc > 10.8:  #11.0592M
+            foc_value_1 = 0x80
+            foc_value_2 = 0x7D
+        elif self.fosc < 18.8 and self.fosc > 18.0:  #18.432M
+            foc_value_1 = 0x40
+            foc_value_2 = 0x31
+        elif self.fosc < 6.3 and self.fosc > 5.7:#6M
+            foc_value_1 = 0xC0
+            foc_value_2 = 0x9f
+        elif self.fosc < 5.9 and self.fosc > 5.0:  #5.5296M
+            foc_value_1 = 0xC0
+            foc_value_2 = 0x7B
+                      
+        return [0x6d, 0x40, Timer1_value >> 8, Timer1_value & 0xff, foc_value_1,foc_value_2, 0x81]
+        #return [0x6b, 0x40, 0xff,0xf4,   0x40,0x92, 0x81]
+
+    async def handshake(self):
+        baud0 = self.transport.baudrate
         
-        if self.protocol in PROTOSET_8:
-            baud = 115200 #若没指定波特率，默认为115200
-            if highbaud_pre != 115200:
-                baud = highbaud_pre
-            #支持460800以内的任意波特率
+        if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+            #支持460800以内的任意波特率，从指定波特率开始逐级向下尝试
             #典型波特率：460800、230400、115200、57600、38400、28800、19200、14400、9600、4800
-            if baud in range(460801): 
-                #定时器1重载值计算微调，可能由于目标芯片的差异性需要微调
-                if baud in [300000,350000]:
-                    Timer1_value = int(65536.2 - float(24.0 * 1000000 / 4 / baud))  
-                else: 
-                    Timer1_value = int(65536.5 - float(24.0 * 1000000 / 4 / baud))  
-
-                if self.fosc < 24.5 and self.fosc > 23.5:    #24M
-                    foc_value = 0x7B
-                elif self.fosc < 27.5 and self.fosc > 26.5:  #27M
-                    foc_value = 0xB0
-                elif self.fosc < 22.7 and self.fosc > 21.7:  #22.1184M
-                    foc_value = 0x5A
-                elif self.fosc < 20.5 and self.fosc > 19.5:  #20M
-                    foc_value = 0x35
-                elif self.fosc < 12.3 and self.fosc > 11.7:  #12M
-                    foc_value = 0x7B
-                elif self.fosc < 11.4 and self.fosc > 10.8:  #11.0592M
-                    foc_value = 0x5A
-                elif self.fosc < 18.8 and self.fosc > 18.0:  #18.432M
-                    foc_value = 0x1A
-                elif self.fosc < 6.3 and self.fosc > 5.7:#6M
-                    foc_value = 0x12
-                elif self.fosc < 5.9 and self.fosc > 5.0:  #5.5296M
-                    foc_value = 0x5A
+            ladder = [baud for baud in BAUD_LADDER if baud < self.highbaud]
+            if self.highbaud <= BAUD_LADDER[0]:
+                ladder.insert(0, self.highbaud)
+
+            for baud in ladder:
+                if self.protocol in PROTOSET_8:
+                    baudstr = self.__baudstr_8(baud)
                 else:
-                    foc_value = 0x6B
-                              
-                baudstr = [0x00, 0x00, Timer1_value >> 8, Timer1_value & 0xff, 0x01, foc_value, 0x81]
-                
-                self.send(0x01, baudstr )
-                try:
-                    cmd, dat = self.recv()                   
-                except Exception:
-                    logging.info("Cannot use baudrate %d" % baud)
-                    time.sleep(0.2)
-                    self.conn.flushInput()
-                finally:
-                    self.__conn_baudrate(baud0, False)
-                
-            logging.info("Change baudrate to %d" % baud)
-            self.__conn_baudrate(baud)
-            self.baudrate = baud
-        elif self.protocol in PROTOSET_15:
-            baud = 115200 #若没指定波特率，默认为115200
-            if highbaud_pre != 115200:
-                baud = highbaud_pre
-            #支持460800以内的任意波特率
-            #典型波特率：460800、230400、115200、57600、38400、28800、19200、14400、9600、4800
-            if baud in range(460801): 
-                #定时器1重载值计算微调，可能由于目标芯片的差异性需要微调
-                if baud in [300000,350000]:
-                    Timer1_value = int(65536.2 - float(22.1184 * 1000000 / 4 / baud))  
-                else: 
-                    Timer1_value = int(65536.5 - float(22.1184 * 1000000 / 4 / baud))  
-
-                if self.fosc < 24.5 and self.fosc > 23.5:    #24M
-                    foc_value_1 = 0x40
-                    foc_value_2 = 0x9F
-                elif self.fosc < 27.5 and self.fosc > 26.5:  #27M
-                    foc_value_1 = 0x40
-                    foc_value_2 = 0xDC
-                elif self.fosc < 22.7 and self.fosc > 21.7:  #22.1184M
-                    foc_value_1 = 0x40
-                    foc_value_2 = 0x79
-                elif self.fosc < 20.5 and self.fosc > 19.5:  #20M
-                    foc_value_1 = 0x40
-                    foc_value_2 = 0x4F
-                elif self.fosc < 12.3 and self.fosc > 11.7:  #12M
-                    foc_value_1 = 0x80
-                    foc_value_2 = 0xA2
-                elif self.fosc < 11.4 and self.fosc > 10.8:  #11.0592M
-                    foc_value_1 = 0x80
-                    foc_value_2 = 0x7D
-                elif self.fosc < 18.8 and self.fosc > 18.0:  #18.432M
-                    foc_value_1 = 0x40
-                    foc_value_2 = 0x31
-                elif self.fosc < 6.3 and self.fosc > 5.7:#6M
-                    foc_value_1 = 0xC0
-                    foc_value_2 = 0x9f
-                elif self.fosc < 5.9 and self.fosc > 5.0:  #5.5296M
-                    foc_value_1 = 0xC0
-                    foc_value_2 = 0x7B
-                              
-                baudstr = [0x6d, 0x40, Timer1_value >> 8, Timer1_value & 0xff, foc_value_1,foc_value_2, 0x81]
-                #baudstr = [0x6b, 0x40, 0xff,0xf4,   0x40,0x92, 0x81]
-                
-                self.send(0x01, baudstr )
+                    baudstr = self.__baudstr_15(baud)
+
+                logging.info("Test baudrate %d using config %s"
+                             % (baud, " ".join(["%02X" % i for i in baudstr])))
+
+                # The reply comes at the handshake rate, the chip then
+                # moves to the new one; a prepare command confirms it
                 try:
-                    cmd, dat = self.recv()                   
+                    with self.tracer.span("try baudrate", baud=baud):
+                        await self.send(0x01, baudstr)
+                        cmd, dat = await self.recv()
+                        await self.__conn_baudrate(baud)
+                        await self.send(0x05, [0x00, 0x00, 0x5A, 0xA5])
+                        cmd, dat = await self.recv()
+                    break
                 except Exception:
                     logging.info("Cannot use baudrate %d" % baud)
-                    time.sleep(0.2)
-                    self.conn.flushInput()
-                finally:
-                    self.__conn_baudrate(baud0, False)
-                
+                    if baud == ladder[-1]:
+                        raise IOError("波特率均不可用: %s"
+                                      % ", ".join(str(i) for i in ladder))
+                    # The chip may already have moved to the new rate and
+                    # no longer listens at the old one, so the next rate
+                    # is only tried after it has been brought back to the
+                    # sync pulses
+                    self.report(ResyncEvent(baud))
+                    with self.tracer.span("resync"):
+                        try:
+                            await self.resync()
+                        except IOError as e:
+                            tried = ladder[:ladder.index(baud) + 1]
+                            raise IOError("波特率 %s 不可用，%s"
+                                          % (", ".join(str(i) for i in tried),
+                                             str(e) or "目标未重新连接"))
+
             logging.info("Change baudrate to %d" % baud)
-            self.__conn_baudrate(baud)
             self.baudrate = baud
         else:
-            for baud in [115200, 57600, 38400, 28800, 19200,
-                     14400, 9600, 4800, 2400, 1200]:
+            ladder = [115200, 57600, 38400, 28800, 19200,
+                      14400, 9600, 4800, 2400, 1200]
+            cached = None
+            if self.handshake_cache is not None:
+                cached = self.handshake_cache.lookup(self)
+                if cached in ladder:
+                    ladder.remove(cached)
+                    ladder.insert(0, cached)
+
+            for baud in ladder:
 
                 t = self.fosc * 1000000 / baud / 32
                 if self.protocol not in PROTOSET_89:
@@ -800,42 +1055,46 @@ class Programmer:
 
                 logging.info("Waiting time config %02X" % (0x80 + twait))
 
-                self.send(0x8F, baudstr + [0x80 + twait])
+                await self.send(0x8F, baudstr + [0x80 + twait])
 
                 try:
-                    self.__conn_baudrate(baud)
-                    cmd, dat = self.recv()
+                    with self.tracer.span("try baudrate", baud=baud):
+                        await self.__conn_baudrate(baud)
+                        cmd, dat = await self.recv()
                     break
                 except Exception:
                     logging.info("Cannot use baudrate %d" % baud)
 
-                    time.sleep(0.2)
-                    self.conn.flushInput()
+                    await self.__delay("retry")
+                    self.__conn_flush_input()
                 finally:
-                    self.__conn_baudrate(baud0, False)
+                    await self.__conn_baudrate(baud0, False)
 
             else:
                 raise IOError()
             logging.info("Change baudrate to %d" % baud)
 
-            self.send(0x8E, baudstr)
-            self.__conn_baudrate(baud)
+            await self.send(0x8E, baudstr)
+            await self.__conn_baudrate(baud)
             self.baudrate = baud
 
-            cmd, dat = self.recv()
+            cmd, dat = await self.recv()
 
+            if self.handshake_cache is not None and baud != cached:
+                await self.handshake_cache.record(self, baud, 0x80 + twait)
+
+
+    async def erase(self):
+        self.erased = False
 
-    def erase(self):
         if self.protocol in PROTOSET_89:
-            self.send(0x84, [0x01, 0x33, 0x33, 0x33, 0x33, 0x33, 0x33])
-            cmd, dat = self.recv(10)
+            await self.send(0x84, [0x01, 0x33, 0x33, 0x33, 0x33, 0x33, 0x33])
+            cmd, dat = await self.recv(kind="erase")
             assert cmd == 0x80
         
         elif self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15: 
-            self.send(0x05, [0x00, 0x00, 0x5A, 0xA5])
-            cmd, dat = self.recv(10)
-            self.send(0x03, [0x00, 0x00, 0x5A, 0xA5])
-            cmd, dat = self.recv(10)
+            await self.send(0x03, [0x00, 0x00, 0x5A, 0xA5])
+            cmd, dat = await self.recv(kind="erase")
             for i in range(7):
                 dat[i] = hex(dat[i])
                 dat[i] = str(dat[i])
@@ -848,46 +1107,136 @@ class Programmer:
             for i in dat:
                 serial_number = serial_number +str(i)
             self.serial_number = str(serial_number)
-            print("\r")
-            sys.stdout.write("芯片出厂序列号: ")
-            sys.stdout.write(self.serial_number.upper())
-            sys.stdout.flush()
-            print("\r")
 
         else:
-            self.send(0x84, ([0x00, 0x00, self.romsize * 4,
+            await self.send(0x84, ([0x00, 0x00, self.romsize * 4,
                               0x00, 0x00, self.romsize * 4]
                              + [0x00] * 12
                              + [i for i in range(0x80, 0x0D, -1)]))
-            cmd, dat = self.recv(10)
+            cmd, dat = await self.recv(kind="erase")
             if dat:
                 logging.info("Serial number: "
                              + " ".join(["%02X" % j for j in dat]))
 
-    def flash(self, code):
-        code = list(code) + [0xff] * (511 - (len(code) - 1) % 512)
+        self.erased = True
+
+    async def flash(self, code, sparse=False, checksums=None, start=0,
+                    patches=None):
+        # Blocks are sent straight from the image, padded to 512 bytes,
+        # except those replaced by patches ({offset: 128 bytes})
+        try:
+            code = memoryview(code).cast("B")
+        except TypeError:
+            code = memoryview(bytearray(code))
+        if patches is None:
+            patches = {}
+        size = max([len(code)] + [i + 128 for i in patches])
+        size += 511 - (size - 1) % 512
+
+        # Blocks left blank by erase() need not be sent at all
+        sparse = sparse and self.erased and self.protocol in PROTOSET_SPARSE
+
+        if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+            addr = bytearray([0, 0, 0x5A, 0xA5])
+            pos = 0
+        else:
+            addr = bytearray([0, 0, 0, 0, 0, 128])
+            pos = 2
         
-        for i in range(0, len(code), 128):
-            logging.info("Flash code region (%04X, %04X)" % (i, i + 127))
-           
-            if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
-                flag_test = 1
-                addr = [i >> 8, i & 0xFF, 0x5A, 0xA5]
-                if flag_test == 1:
-                    self.send(0x22, addr + code[i:i+128])
-                    flag_test = 10
-                else:
-                    self.send(0x02, addr + code[i:i+128])
+        self.flashed = start
+        for i in range(start, size, 128):
+            if i in patches:
+                block = patches[i]
             else:
-                addr = [0, 0, i >> 8, i & 0xFF, 0, 128]
-                self.send(0x00, addr + code[i:i+128])
-            cmd, dat = self.recv()
+                block = code[i:i+128]
+                if len(block) < 128:
+                    block = block.tobytes() + BLANK_BLOCK[len(block):]
+
+            if sparse and block == BLANK_BLOCK:
+                logging.info("Skip blank code region (%04X, %04X)",
+                             i, i + 127)
+                self.flashed = i + 128
+                yield (i + 128.0) / size
+                continue
 
-            #assert dat[0] == sum(code[i:i+128]) % 256
+            logging.info("Flash code region (%04X, %04X)", i, i + 127)
 
-            yield (i + 128.0) / len(code)
+            # The legacy bootloaders answer with the sum of the block, the
+            # STC8/STC15 ones with a status byte
+            if checksums is None:
+                expect = None
+            elif self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+                expect = 0x54
+            elif i in patches or i >> 7 >= len(checksums):
+                expect = sum(block) & 0xFF
+            else:
+                expect = checksums[i >> 7]
+
+            backoff = BLOCK_BACKOFF
+            for retry in range(BLOCK_RETRIES + 1):
+                if retry:
+                    await self.transport.sleep(backoff)
+                    self.__conn_flush_input()
+                    backoff *= 2
+                with self.tracer.span("block", addr=i, retry=retry):
+                    if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
+                        flag_test = 1
+                        addr[pos] = i >> 8
+                        addr[pos+1] = i & 0xFF
+                        if flag_test == 1:
+                            await self.send(0x22, addr, block)
+                            flag_test = 10
+                        else:
+                            await self.send(0x02, addr, block)
+                    else:
+                        addr[pos] = i >> 8
+                        addr[pos+1] = i & 0xFF
+                        await self.send(0x00, addr, block)
+                    try:
+                        cmd, dat = await self.recv(kind="write")
+                    except IOError:
+                        logging.info("No reply at %04X", i)
+                        error = SessionLost("写入超时: %04X" % i)
+                        continue
 
-    def options(self, **kwargs):
+                if expect is None or (dat and dat[0] == expect):
+                    break
+                logging.info("Verify failed at %04X (%s, expected %02X)",
+                             i, "%02X" % dat[0] if dat else "-", expect)
+                error = IOError("校验失败: %04X" % i)
+            else:
+                raise error
+
+            self.flashed = i + 128
+            yield (i + 128.0) / size
+
+    # Detect the same chip again at the handshake rate, once it has been
+    # reset by the reset magic or by hand
+    async def resync(self):
+        model, fingerprint = self.model, self.fingerprint
+
+        self.transport.baudrate = self.lowbaud
+        self.transport.parity = self.lowparity
+        self.__conn_flush_input()
+        self.chkmode = 0
+
+        if self.reset is not None:
+            await self.reset()
+        await self.detect()
+        if self.model != model or self.fingerprint != fingerprint:
+            raise IOError("目标已更换")
+
+        await self.unknown_packet_1()
+
+    # Take up a session that broke off during flash(): detect the target
+    # again, which has to be the same chip, and switch to the high rate,
+    # leaving what was erased and written so far in place
+    async def rejoin(self):
+        await self.resync()
+        await self.handshake()
+        await self.unknown_packet_2()
+
+    async def options(self, **kwargs):
         erase_eeprom = kwargs.get("erase_eeprom", None)
 
         dat = []
@@ -918,171 +1267,1500 @@ class Programmer:
             return False
 
         if dat:
-            self.send(0x8D, dat)
-            cmd, dat = self.recv()
+            await self.send(0x8D, dat)
+            cmd, dat = await self.recv()
 
         return True
 
-    def terminate(self):
+    async def terminate(self):
         logging.info("Send termination command")
 
         if self.protocol in PROTOSET_8 or self.protocol in PROTOSET_15:
-            self.send(0xFF, [])
+            await self.send(0xFF, [])
         else:
-            self.send(0x82, [])
-        self.conn.flush()
-        time.sleep(0.2)
+            await self.send(0x82, [])
+        with self.tracer.span("drain"):
+            await self.transport.drain()
+        await self.__delay("terminate")
 
-    def unknown_packet_1(self):
+    async def unknown_packet_1(self):
         if self.protocol in PROTOSET_PARITY:
             logging.info("Send unknown packet (50 00 00 36 01 ...)")
-            self.send(0x50, [0x00, 0x00, 0x36, 0x01] + self.model)
-            cmd, dat = self.recv()
+            await self.send(0x50, [0x00, 0x00, 0x36, 0x01] + self.model)
+            cmd, dat = await self.recv()
             assert cmd == 0x8F and not dat
 
-    def unknown_packet_2(self):
+    async def unknown_packet_2(self):
         if self.protocol not in PROTOSET_PARITY and self.protocol not in PROTOSET_8 and self.protocol not in PROTOSET_15:
             for i in range(5):
                 logging.info("Send unknown packet (80 00 00 36 01 ...)")
-                self.send(0x80, [0x00, 0x00, 0x36, 0x01] + self.model)
-                cmd, dat = self.recv()
+                await self.send(0x80, [0x00, 0x00, 0x36, 0x01] + self.model)
+                cmd, dat = await self.recv()
                 assert cmd == 0x80 and not dat
 
-    def unknown_packet_3(self):
+    async def unknown_packet_3(self):
         if self.protocol in PROTOSET_PARITY:
             logging.info("Send unknown packet (69 00 00 36 01 ...)")
-            self.send(0x69, [0x00, 0x00, 0x36, 0x01] + self.model)
-            cmd, dat = self.recv()
+            await self.send(0x69, [0x00, 0x00, 0x36, 0x01] + self.model)
+            cmd, dat = await self.recv()
             assert cmd == 0x8D and not dat
 
 
-def autoisp(conn, baud, magic):
-    if not magic:
-        return
+# Blocking transport over a pyserial port; its coroutines never suspend
+class SerialTransport:
+    def __init__(self, conn):
+        self.conn = conn
+        self.port = getattr(conn, "port", None)
+        self.conn.timeout = READ_TIMEOUT
 
-    bak = conn.baudrate
-    conn.baudrate = baud
-    conn.write(bytearray(ord(i) for i in magic))
-    conn.flush()
-    time.sleep(0.5)
-    conn.baudrate = bak
+    @property
+    def baudrate(self):
+        return self.conn.baudrate
 
+    @baudrate.setter
+    def baudrate(self, baud):
+        self.conn.baudrate = baud
 
-def program(prog, code, erase_eeprom=None):
-    sys.stdout.write("检测目标...")
-    sys.stdout.flush()
+    @property
+    def parity(self):
+        return self.conn.parity
 
-    prog.detect()
+    @parity.setter
+    def parity(self, parity):
+        self.conn.parity = parity
 
-    print("完成")
+    async def read(self, timeout):
+        if self.conn.timeout != timeout:
+            self.conn.timeout = timeout
+        return self.conn.read(self.conn.in_waiting or 1)
 
-    prog.print_info() 
+    async def write(self, s):
+        self.conn.write(s)
 
-    if prog.protocol is None:
-        raise IOError("未知目标")
+    async def drain(self):
+        self.conn.flush()
 
-    if code is None:
-        return
+    def flush_input(self):
+        self.conn.flushInput()
 
-    prog.unknown_packet_1() 
+    async def sleep(self, seconds):
+        time.sleep(seconds)
 
-    sys.stdout.write("切换至最高波特率: ")
-    sys.stdout.flush()
 
-    prog.handshake() 
+# Non-blocking transport for an asyncio event loop.  pyserial still opens
+# and configures the port, but reads and writes go straight to its file
+# descriptor, so one loop can serve any number of ports (POSIX only).
+class AsyncSerialTransport(SerialTransport):
+    def __init__(self, conn, loop=None):
+        SerialTransport.__init__(self, conn)
+        self.fd = conn.fileno()
+        self.loop = loop or asyncio.get_event_loop()
+        os.set_blocking(self.fd, False)
 
-    print("%d bps"% prog.baudrate) 
+    async def __ready(self, add, remove, timeout):
+        ready = self.loop.create_future()
+        add(self.fd, lambda: ready.done() or ready.set_result(None))
+        try:
+            await asyncio.wait_for(ready, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            remove(self.fd)
 
-    prog.unknown_packet_2()
+    async def read(self, timeout):
+        # pyserial sets VMIN = VTIME = 0, so an idle port reads as empty
+        for i in range(2):
+            try:
+                s = os.read(self.fd, 4096)
+            except BlockingIOError:
+                s = b""
+            if s or i:
+                return s
+            if not await self.__ready(self.loop.add_reader,
+                                      self.loop.remove_reader, timeout):
+                return b""
+
+    async def write(self, s):
+        s = memoryview(s)
+        while s:
+            try:
+                s = s[os.write(self.fd, s):]
+            except BlockingIOError:
+                await self.__ready(self.loop.add_writer,
+                                   self.loop.remove_writer, None)
 
-    sys.stdout.write("开始擦除芯片...")
-    sys.stdout.flush()
+    async def drain(self):
+        # Wait until the driver has put everything on the wire
+        while self.conn.out_waiting:
+            await asyncio.sleep(0.002)
 
-    time_start = time.time()
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
 
-    prog.erase() 
 
-    print("擦除完成")
+# Run a coroutine of the engine on a blocking transport, where it finishes
+# without ever suspending
+def run_sync(coro):
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("blocking transport suspended")
 
-    print("代码长度: %d bytes" % len(code)) 
 
+# Blocking programmer on a pyserial port, a thin wrapper over the engine
+class Programmer:
+    def __init__(self, conn, protocol=None, recorder=None, highbaud=115200,
+                 handshake_cache=None):
+        self.__dict__["conn"] = conn
+        self.__dict__["engine"] = AsyncProgrammer(SerialTransport(conn),
+                                                  protocol, recorder,
+                                                  highbaud, handshake_cache)
 
-    # print("Programming: ", end="", flush=True)
-    sys.stdout.write("正在下载用户代码...")  
-    sys.stdout.flush()  
+    # Target state (model, fosc, baudrate...) lives in the engine
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
 
-    oldbar = 0
-    for progress in prog.flash(code): 
-        bar = int(progress * 25)  
-        sys.stdout.write("#" * (bar - oldbar)) 
-        sys.stdout.flush()   
-        oldbar = bar
+    def __setattr__(self, name, value):
+        setattr(self.engine, name, value)
 
-    print(" 完成")
+    def recv(self, timeout=None, start=[0x46, 0xB9, 0x68], kind="reply"):
+        return run_sync(self.engine.recv(timeout, start, kind))
 
-    prog.unknown_packet_3() 
+    def send(self, cmd, dat, payload=b""):
+        run_sync(self.engine.send(cmd, dat, payload))
 
-    sys.stdout.write("设置选项...") 
-    sys.stdout.flush()
+    def detect(self):
+        run_sync(self.engine.detect())
 
-    if prog.options(erase_eeprom=erase_eeprom):
-        print("设置完成")
-    else:
-        print("设置失败")
+    def handshake(self):
+        run_sync(self.engine.handshake())
 
-    prog.terminate() 
-    time_end = time.time()
-    print("耗时: %.3fs"% (time_end-time_start))
+    def erase(self):
+        run_sync(self.engine.erase())
 
+    def flash(self, code, sparse=False, checksums=None):
+        steps = self.engine.flash(code, sparse, checksums)
+        while True:
+            try:
+                progress = run_sync(steps.__anext__())
+            except StopAsyncIteration:
+                return
+            yield progress
 
-# Convert Intel HEX code to binary format
-def hex2bin(code):
-    buf = bytearray()
-    base = 0
-    line = 0
+    def options(self, **kwargs):
+        return run_sync(self.engine.options(**kwargs))
+
+    def terminate(self):
+        run_sync(self.engine.terminate())
+
+    def unknown_packet_1(self):
+        run_sync(self.engine.unknown_packet_1())
+
+    def unknown_packet_2(self):
+        run_sync(self.engine.unknown_packet_2())
+
+    def unknown_packet_3(self):
+        run_sync(self.engine.unknown_packet_3())
+
+
+def autoisp(conn, baud, magic, delay=TIMING_DEFAULTS["autoisp"]):
+    run_sync(autoisp_async(SerialTransport(conn), baud, magic, delay))
 
-    for rec in code.splitlines():
-        # Calculate the line number of the current record
-        line += 1
 
+async def autoisp_async(transport, baud, magic,
+                        delay=TIMING_DEFAULTS["autoisp"]):
+    if not magic:
+        return
+
+    bak = transport.baudrate
+    transport.baudrate = baud
+    await transport.write(bytearray(ord(i) for i in magic))
+    await transport.drain()
+    await transport.sleep(delay)
+    transport.baudrate = bak
+
+
+# Sum of every 128-byte block of the padded image, modulo 256, as echoed
+# by the legacy bootloaders after each write
+def block_checksums(code):
+    try:
+        code = memoryview(code).cast("B")
+    except TypeError:
+        code = memoryview(bytearray(code))
+    size = len(code) + (511 - (len(code) - 1) % 512)
+
+    table = bytearray([sum(BLANK_BLOCK) & 0xFF]) * (size // 128)
+    for i in range(0, len(code), 128):
+        block = code[i:i+128]
+        table[i >> 7] = (sum(block.tobytes()) + 0xFF * (128 - len(block))) & 0xFF
+    return table
+
+
+def image_digest(code):
+    try:
+        return hashlib.sha256(code).hexdigest()
+    except TypeError:
+        return hashlib.sha256(bytes(bytearray(code))).hexdigest()
+
+
+# Replace a file in one step so readers never see a partial update
+def atomic_write(path, data):
+    fd, tmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path),
+                               dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# A file shared between ports and processes, guarded by a lock file beside
+# it.  The lock is polled rather than waited on, so that the other ports
+# on the same event loop keep running while one port holds it.
+class LockedFile:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    async def acquire(self, sleep):
+        while not self.lock.acquire(False):
+            await sleep(LOCK_POLL)
         try:
-            # bytes(...) is to support python<=2.6
-            # bytearray(...) is to support python<=2.7
-            n = bytearray(binascii.a2b_hex(bytes(rec[1:3])))[0]
-            dat = bytearray(binascii.a2b_hex(bytes(rec[1:n*2+11])))
-        except:
-            raise Exception("Line %d: Invalid format" % line)
+            lock = open(self.path + ".lock", "a")
+            while fcntl is not None:
+                try:
+                    fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    await sleep(LOCK_POLL)
+        except BaseException:
+            self.lock.release()
+            raise
+        self.file = lock
+
+    def release(self):
+        self.file.close()
+        self.file = None
+        self.lock.release()
+
+
+# JSON entries keyed by name, each stamped with the time it was last
+# written; the least recently used go once there are more than size.
+# Writes replace the file in one step, so reading needs no lock.
+class JsonStore(LockedFile):
+    def __init__(self, path, size):
+        LockedFile.__init__(self, path)
+        self.size = size
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                return json.loads(f.read().decode("utf-8"))["entries"]
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def get(self, key):
+        return self.load().get(key)
+
+    async def put(self, key, entry, sleep):
+        await self.acquire(sleep)
+        try:
+            entries = self.load()
+            entries[key] = dict(entry, used=time.time())
+            if len(entries) > self.size:
+                lru = sorted(entries, key=lambda k: entries[k]["used"])
+                for name in lru[:len(entries) - self.size]:
+                    del entries[name]
+            data = json.dumps({"version": 1, "entries": entries}, indent=1)
+            atomic_write(self.path, data.encode("utf-8"))
+        finally:
+            self.release()
+
+
+# Baud rate that last passed the legacy handshake, per port, model and
+# clock band, so that the next unit tries it before walking the ladder
+class HandshakeCache:
+    def __init__(self, path, size=HANDSHAKE_CACHE_SIZE):
+        self.store = JsonStore(path, size)
+
+    def key(self, prog):
+        # Measured clocks of one crystal stay well within a 0.25MHz band
+        return "%s|%02X%02X|%.2f" % (prog.transport.port,
+                                     prog.model[0], prog.model[1],
+                                     round(prog.fosc * 4) / 4.0)
+
+    def lookup(self, prog):
+        entry = self.store.get(self.key(prog))
+        if entry is None:
+            return None
+        logging.info("Cached handshake: %d bps, wait config %02X"
+                     % (entry["baud"], entry["wait"]))
+        return entry["baud"]
+
+    async def record(self, prog, baud, wait):
+        await self.store.put(self.key(prog), {"baud": baud, "wait": wait},
+                             prog.transport.sleep)
+
+
+# How long the target takes to answer: the frames on the wire both ways
+# at the current rate plus the time it works on the command, which for an
+# erase grows with the size of the flash.  The working times start out
+# from LATENCY_DEFAULTS; with a file the slowest answers seen are kept in
+# it and used instead, so that the timeouts follow the actual adapter and
+# chips.  Remove the file to measure again.
+class LatencyModel:
+    def __init__(self, path=None, margin=TIMEOUT_MARGIN, slack=TIMEOUT_SLACK):
+        self.path = path
+        self.margin = margin
+        self.slack = slack
+        self.values = dict(LATENCY_DEFAULTS)
+        self.measured = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path is not None:
+            self.measured = self.__load()
+            self.values.update(self.measured)
+
+    def __load(self):
+        try:
+            with open(self.path, "rb") as f:
+                doc = json.loads(f.read().decode("utf-8"))
+            return dict((kind, float(doc["latency"][kind]))
+                        for kind in LATENCY_DEFAULTS if kind in doc["latency"])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def work(self, kind, romsize=None):
+        if kind == "erase":
+            return self.values[kind] * (romsize or 64)
+        return self.values[kind]
+
+    def timeout(self, kind, wire, romsize=None):
+        return self.margin * (wire + self.work(kind, romsize)) + self.slack
+
+    def observe(self, kind, elapsed, romsize=None):
+        if self.path is None:
+            return
+        if kind == "erase":
+            elapsed /= romsize or 64
+        with self.lock:
+            if elapsed > self.measured.get(kind, 0):
+                self.measured[kind] = elapsed
+                self.values[kind] = elapsed
+                self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if self.path is None or not self.dirty:
+                return
+            measured = self.__load()
+            for kind, value in self.measured.items():
+                measured[kind] = max(value, measured.get(kind, 0))
+            data = json.dumps({"version": 1, "latency": measured}, indent=1)
+            atomic_write(self.path, data.encode("utf-8"))
+            self.dirty = False
+
+
+def timing_family(protocol):
+    if protocol in PROTOSET_8:
+        return "8"
+    if protocol in PROTOSET_15:
+        return "15"
+    if protocol == PROTOCOL_89:
+        return "89"
+    if protocol is not None:
+        return "12c"
+    return None
+
+
+# The timing profiles in use: TIMING_PROFILES, overridden by those a
+# calibration left in a file
+class Timing:
+    def __init__(self, path=None):
+        self.path = path
+        self.profiles = dict((family, dict(profile))
+                             for family, profile in TIMING_PROFILES.items())
+        if path is not None:
+            try:
+                with open(path, "rb") as f:
+                    doc = json.loads(f.read().decode("utf-8"))
+                for family, profile in doc["profiles"].items():
+                    self.profiles[family].update(
+                        (name, float(profile[name]))
+                        for name in TIMING_DEFAULTS if name in profile)
+            except (IOError, OSError, ValueError, KeyError, TypeError):
+                logging.info("No timing profiles in %s" % path)
+
+    def get(self, protocol, name):
+        return self.profiles.get(timing_family(protocol),
+                                 TIMING_DEFAULTS)[name]
+
+    def save(self):
+        data = json.dumps({"version": 1, "profiles": self.profiles}, indent=1)
+        atomic_write(self.path, data.encode("utf-8"))
+
+
+# Per-unit data written into every chip at a fixed address: the value of a
+# counter, or the row of a CSV file it points at, put through a format.
+# The format is a struct format such as "<I" for binary values, "hex" for
+# hex digits taken from a CSV row (such as a MAC address), or else a %
+# format such as "SN%08d" for text.  The counter is advanced in its file
+# before the chip is programmed, so a value is never handed out twice,
+# even if programming fails or the program dies on the way.
+class Serializer:
+    def __init__(self, address, fmt, counter, rows=None, start=0):
+        self.address = address
+        self.fmt = fmt
+        self.counter = counter
+        self.rows = rows
+        self.start = start
+        self.file = LockedFile(counter)
+
+        if fmt == "hex" and rows is None:
+            raise ValueError("hex format needs a CSV file")
+
+    async def __take(self, sleep):
+        await self.file.acquire(sleep)
+        try:
+            try:
+                with open(self.counter, "rb") as f:
+                    value = int(f.read().decode("utf-8").strip() or self.start)
+            except (IOError, OSError):
+                value = self.start
+            if self.rows is not None and value >= len(self.rows):
+                raise IOError("序列号已用完: %s" % self.counter)
+            atomic_write(self.counter, ("%d\n" % (value + 1)).encode("utf-8"))
+        finally:
+            self.file.release()
+        return value
+
+    def encode(self, value):
+        if self.rows is not None:
+            values = self.rows[value]
+        else:
+            values = [value]
+
+        if self.fmt == "hex":
+            return bytes(bytearray.fromhex("".join(values).replace(":", "")
+                                           .replace("-", "")))
+        if self.fmt and self.fmt[0] in "<>!=@":
+            return struct.pack(self.fmt, *[int(i, 0) if isinstance(i, str)
+                                           else i for i in values])
+        return (self.fmt % tuple(values)).encode("utf-8")
+
+    # Take the next value; returns it for display, along with the blocks
+    # of code it changes, as {offset: 128 bytes}
+    async def allocate(self, code, sleep):
+        value = await self.__take(sleep)
+        data = self.encode(value)
+        name = (",".join(self.rows[value]) if self.rows is not None
+                else str(value))
+        return name, overlay(code, self.address, data)
+
+
+def load_rows(path):
+    with open(path) as f:
+        return [row for row in csv.reader(f)
+                if row and not row[0].startswith("#")]
+
+
+# The 128-byte blocks of code that change when data is written at address,
+# copied from the code (blank beyond its end) and patched; the rest of the
+# image is left shared
+def overlay(code, address, data):
+    blocks = {}
+    end = address + len(data)
+    for i in range(address & ~127, end, 128):
+        block = bytearray(code[i:i+128])
+        block += BLANK_BLOCK[len(block):]
+        lo = max(address, i)
+        hi = min(end, i + 128)
+        block[lo - i:hi - i] = data[lo - address:hi - address]
+        blocks[i] = bytes(block)
+    return blocks
+
+
+# Events delivered to the callback of program_async() and program_device()
+PhaseEvent = collections.namedtuple("PhaseEvent", "phase")
+InfoEvent = collections.namedtuple("InfoEvent", "info")
+BaudEvent = collections.namedtuple("BaudEvent", "baud")
+EraseEvent = collections.namedtuple("EraseEvent", "serial")
+ProgressEvent = collections.namedtuple("ProgressEvent", "progress size")
+OptionsEvent = collections.namedtuple("OptionsEvent", "ok")
+DoneEvent = collections.namedtuple("DoneEvent", "time")
+RecorderEvent = collections.namedtuple("RecorderEvent", "path")
+ResumeEvent = collections.namedtuple("ResumeEvent", "addr")
+ResyncEvent = collections.namedtuple("ResyncEvent", "baud")
+UnitEvent = collections.namedtuple("UnitEvent", "value")
+
+
+def event_dict(event):
+    d = dict(event._asdict())
+    d["event"] = type(event).__name__[:-len("Event")].lower()
+    return d
+
+
+# Passes progress on at most once per interval, and always at the start
+# and the end; other events go through unchanged
+class Throttle:
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.last = 0
+
+    def __call__(self, event):
+        if type(event) is ProgressEvent and 0 < event.progress < 1:
+            now = time.time()
+            if now - self.last < self.interval:
+                return
+            self.last = now
+        self.callback(event)
+
+
+# The command line output, rendered from the events
+class ConsoleReport:
+    def __init__(self, out=None):
+        self.out = out if out is not None else sys.stdout
+        self.bar = 0
+
+    def __call__(self, event):
+        out = self.out
+        kind = type(event)
+
+        if kind is PhaseEvent:
+            if event.phase == "detect":
+                out.write("检测目标...")
+            elif event.phase == "handshake":
+                out.write("切换至最高波特率: ")
+            elif event.phase == "erase":
+                out.write("开始擦除芯片...")
+            elif event.phase == "options":
+                out.write("设置选项...") 
+            out.flush()
+
+        elif kind is InfoEvent:
+            print("完成 (%.3fs)" % event.info["detect_time"], file=out)
+            print_device_info(event.info, out)
+
+        elif kind is BaudEvent:
+            print("%d bps" % event.baud, file=out) 
+
+        elif kind is EraseEvent:
+            if event.serial:
+                print("\r", file=out)
+                out.write("芯片出厂序列号: ")
+                out.write(event.serial.upper())
+                print("\r", file=out)
+            print("擦除完成", file=out)
+
+        elif kind is ProgressEvent:
+            if event.progress == 0:
+                print("代码长度: %d bytes" % event.size, file=out) 
+                out.write("正在下载用户代码...")  
+                self.bar = 0
+            bar = int(event.progress * 25)  
+            out.write("#" * (bar - self.bar)) 
+            out.flush()   
+            self.bar = bar
+            if event.progress >= 1:
+                print(" 完成", file=out)
+
+        elif kind is OptionsEvent:
+            print("设置完成" if event.ok else "设置失败", file=out)
+
+        elif kind is DoneEvent:
+            print("耗时: %.3fs" % event.time, file=out)
+
+        elif kind is UnitEvent:
+            print("写入产品序列号: %s" % event.value, file=out)
+
+        elif kind is ResumeEvent:
+            print("\n通信中断，等待目标重新连接后从 %04X 继续下载..."
+                  % event.addr, file=out)
+            out.write("正在下载用户代码..." + "#" * self.bar)
+            out.flush()
+
+        elif kind is ResyncEvent:
+            print("%d bps 不可用，等待目标重新连接..." % event.baud, file=out)
+            out.write("切换至最高波特率: ")
+            out.flush()
+
+        elif kind is RecorderEvent:
+            print("\n通信记录已保存至 %s" % event.path, file=out)
+
+
+def program(prog, code, erase_eeprom=None, out=None, sparse=False,
+            checksums=None):
+    run_sync(program_async(prog.engine, code, erase_eeprom, sparse,
+                           Throttle(ConsoleReport(out)), checksums))
+
+
+async def program_async(prog, code, erase_eeprom=None, sparse=False,
+                        report=None, checksums=None):
+    if report is None:
+        report = lambda event: None
+
+    try:
+        with prog.tracer.span("program"):
+            await _program(prog, code, erase_eeprom, sparse, report,
+                           checksums)
+    except Exception as e:
+        # Nothing worth keeping when no chip answered at all, as when
+        # --loop waits for the next one
+        if prog.recorder is not None and prog.detect_time is not None:
+            path = prog.recorder.dump("%s: %s" % (e.__class__.__name__, e))
+            report(RecorderEvent(path))
+        raise
+
+    if prog.recorder is not None and prog.recorder.always:
+        report(RecorderEvent(prog.recorder.dump()))
+
+
+async def _program(prog, code, erase_eeprom, sparse, report, checksums):
+    prog.report = report
+    report(PhaseEvent("detect"))
+    with prog.tracer.span("detect"):
+        await prog.detect()
+    report(InfoEvent(prog.device_info()))
+
+    if prog.protocol is None:
+        raise IOError("未知目标")
+
+    if code is None:
+        return
+
+    report(PhaseEvent("handshake"))
+    with prog.tracer.span("handshake"):
+        await prog.unknown_packet_1() 
+        await prog.handshake() 
+        await prog.unknown_packet_2()
+    report(BaudEvent(prog.baudrate))
+
+    report(PhaseEvent("erase"))
+    time_start = time.time()
+    with prog.tracer.span("erase"):
+        await prog.erase() 
+    report(EraseEvent(prog.serial_number))
+
+    patches = None
+    if prog.serializer is not None:
+        prog.unit, patches = await prog.serializer.allocate(
+            code, prog.transport.sleep)
+        report(UnitEvent(prog.unit))
+
+    report(PhaseEvent("flash"))
+    report(ProgressEvent(0.0, len(code)))
+    with prog.tracer.span("flash", size=len(code)):
+        resumes = 0
+        while True:
+            try:
+                async for progress in prog.flash(code, sparse, checksums,
+                                                 prog.flashed, patches):
+                    report(ProgressEvent(progress, len(code)))
+                break
+            except SessionLost as e:
+                if resumes >= prog.resume:
+                    raise
+                lost = e
+            resumes += 1
+            report(ResumeEvent(prog.flashed))
+            with prog.tracer.span("resume", addr=prog.flashed):
+                try:
+                    await prog.rejoin()
+                except IOError:
+                    # The chip did not come back; what broke the download
+                    # says more than the failed detection
+                    raise lost from None
+
+    report(PhaseEvent("options"))
+    with prog.tracer.span("options"):
+        await prog.unknown_packet_3() 
+        ok = await prog.options(erase_eeprom=erase_eeprom)
+    report(OptionsEvent(ok))
+
+    report(PhaseEvent("terminate"))
+    with prog.tracer.span("terminate"):
+        await prog.terminate() 
+    report(DoneEvent(time.time() - time_start))
+
+    prog.latency.save()
+
+
+# Expand port names and glob patterns into a list of serial ports
+def expand_ports(patterns):
+    ports = []
+    for pattern in patterns:
+        for item in pattern.split(","):
+            if not item:
+                continue
+            matches = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+            for port in matches:
+                if port not in ports:
+                    ports.append(port)
+    return ports
+
+
+def make_recorder(opts, port):
+    if opts.record:
+        options = dict((key, getattr(opts, key)) for key in JOB_DEFAULTS)
+        options["protocol"] = protocol_name(opts.protocol)
+        return SessionRecorder(opts.record, options)
+    if not opts.flight_recorder:
+        return None
+    name = "stcflash-" + os.path.basename(port).replace(":", "")
+    return FlightRecorder(opts.flight_recorder, name)
+
+
+# Program one chip after another on the same port until interrupted; the
+# port and image are kept and only the protocol runs per unit
+def production_loop(transport, code, opts, handshake_cache=None,
+                    checksums=None, out=None):
+    if out is None:
+        out = sys.stdout
+
+    units = 0
+    failures = 0
+    time_start = time.time()
+    try:
+        while True:
+            transport.baudrate = opts.lowbaud
+            transport.flush_input()
+            if opts.aispmagic:
+                run_sync(autoisp_async(transport, opts.aispbaud,
+                                       opts.aispmagic,
+                                       opts.timing.get(opts.protocol,
+                                                       "autoisp")))
+            prog = make_programmer(transport, opts, opts.port,
+                                   handshake_cache)
+            try:
+                run_sync(program_async(prog, code, opts.erase_eeprom,
+                                       opts.sparse,
+                                       Throttle(ConsoleReport(out)),
+                                       checksums))
+                units += 1
+            except Exception as e:
+                if prog.detect_time is None:
+                    # No chip on the socket yet, keep waiting
+                    out.write("\r")
+                    continue
+                failures += 1
+                print("\n下载失败: %s" % (str(e) or e.__class__.__name__),
+                      file=out)
+
+            elapsed = time.time() - time_start
+            print("已完成: %d  失败: %d  产能: %.0f 片/小时"
+                  % (units, failures, units * 3600.0 / elapsed), file=out)
+            print("等待下一块芯片...", file=out)
+    except KeyboardInterrupt:
+        pass
+
+    elapsed = time.time() - time_start
+    print("\n共完成: %d  失败: %d  用时: %.1fs  产能: %.0f 片/小时"
+          % (units, failures, elapsed, units * 3600.0 / elapsed), file=out)
+    return units, failures
+
+
+# Find the shortest delays of the timing profile that still work with the
+# adapter and the chip on the port.  Each delay is lowered through
+# CALIBRATE_STEPS, programming the chip runs times at every step, until
+# one fails; the step above the shortest one that held is kept.  A chip
+# left hanging by a failure has to be power cycled (or reset by
+# --aispmagic) before the next run.
+def calibrate(transport, code, opts, runs=CALIBRATE_RUNS, out=None):
+    if out is None:
+        out = sys.stdout
+    timing = opts.timing
+
+    def cycle():
+        transport.baudrate = opts.lowbaud
+        transport.flush_input()
+        result = run_sync(program_job(opts.port, transport, code, opts))
+        if not result.ok:
+            print("失败: %s" % result.error, file=out)
+            if not opts.aispmagic:
+                print("请将芯片重新上电", file=out)
+        return result
+
+    print("检测目标...", file=out)
+    result = cycle()
+    if not result.ok:
+        raise IOError("无法下载: %s" % result.error)
+    family = timing_family(result.info["protocol"])
+    profile = timing.profiles[family]
+    print("单片机型号: %s" % result.model, file=out)
+
+    names = ["terminate"]
+    if family in ("89", "12c"):
+        names.insert(0, "settle")
+    if opts.aispmagic:
+        names.append("autoisp")
+
+    for name in names:
+        ok = True
+        default = profile[name]
+        steps = [step for step in CALIBRATE_STEPS if step < default]
+        held = -1
+        for i, step in enumerate(steps):
+            profile[name] = step
+            out.write("%s = %gs: " % (name, step))
+            out.flush()
+            ok = True
+            for run in range(runs):
+                if not cycle().ok:
+                    ok = False
+                    break
+                out.write("#")
+                out.flush()
+            if not ok:
+                break
+            print(" 成功", file=out)
+            held = i
+        # One step of margin above the shortest delay that held
+        chosen = ([default] + steps)[max(0, held)]
+        profile[name] = chosen
+        print("%s: %gs (默认 %gs)" % (name, chosen, default), file=out)
+
+        if not ok:
+            # Get the chip back into a clean session before going on
+            for run in range(runs):
+                if cycle().ok:
+                    break
+            else:
+                raise IOError("目标无响应")
+
+    if timing.path is not None:
+        timing.save()
+        print("时序参数已保存至 %s" % timing.path, file=out)
+
+
+def make_programmer(transport, opts, port, handshake_cache=None):
+    prog = AsyncProgrammer(transport, opts.protocol, make_recorder(opts, port),
+                           opts.highbaud, handshake_cache)
+    prog.detect_timeout = opts.detect_timeout
+    prog.resume = opts.resume
+    prog.tracer = opts.tracer.track(port)
+    prog.latency = opts.latency
+    prog.timing = opts.timing
+    prog.serializer = opts.serializer
+    if opts.aispmagic:
+        prog.reset = lambda: autoisp_async(transport, opts.aispbaud,
+                                           opts.aispmagic,
+                                           opts.timing.get(opts.protocol,
+                                                           "autoisp"))
+    if opts.sync_interval is not None:
+        prog.sync_interval = opts.sync_interval / 1000.0
+    return prog
+
+
+# Outcome of programming one chip
+class Result:
+    def __init__(self, port):
+        self.port = port
+        self.ok = False
+        self.model = None
+        self.serial = None
+        self.baud = None
+        self.detect = None
+        self.time = None
+        self.error = None
+        self.info = None
+        self.unit = None
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+# Program the chip on an open transport, turning any failure into a result.
+# Without a callback the usual console output is kept for the debug log.
+async def program_job(port, transport, code, opts, handshake_cache=None,
+                      report=None, checksums=None):
+    result = Result(port)
+    out = None
+    if report is None:
+        out = io.StringIO()
+        report = Throttle(ConsoleReport(out))
+    time_start = time.time()
+    try:
+        if opts.aispmagic:
+            await autoisp_async(transport, opts.aispbaud, opts.aispmagic,
+                                opts.timing.get(opts.protocol, "autoisp"))
+        prog = make_programmer(transport, opts, port, handshake_cache)
+        try:
+            await program_async(prog, code, opts.erase_eeprom, opts.sparse,
+                                report, checksums)
+        finally:
+            result.model = getattr(prog, "name", None)
+            result.serial = prog.serial_number
+            result.baud = getattr(prog, "baudrate", None)
+            result.detect = prog.detect_time
+            result.unit = prog.unit
+            if result.model is not None:
+                result.info = prog.device_info()
+        result.ok = True
+    except Exception as e:
+        result.error = str(e) or e.__class__.__name__
+        logging.info("%s: %s" % (port, result.error))
+    result.time = time.time() - time_start
+    if out is not None:
+        logging.debug("%s output:\n%s" % (port, out.getvalue()))
+    return result
+
+
+# Library entry point: program the chip on a serial port, given by name or
+# as an open pyserial connection, and return a Result.  Events go to
+# callback with progress throttled to one per progress_interval seconds;
+# options are those a server job takes (JOB_DEFAULTS).
+def program_device(port, code, callback=None,
+                   progress_interval=PROGRESS_INTERVAL,
+                   handshake_cache=None, latency=None, timing=None,
+                   **options):
+    opts = job_options(options)
+    if latency is not None:
+        opts.latency = latency
+    if timing is not None:
+        opts.timing = timing
+    report = (Throttle(callback, progress_interval)
+              if callback is not None else lambda event: None)
+    checksums = block_checksums(code) if opts.verify else None
+
+    if isinstance(port, str):
+        with serial.Serial(port=port,
+                           baudrate=opts.lowbaud,
+                           parity=serial.PARITY_NONE) as conn:
+            return run_sync(program_job(port, SerialTransport(conn), code,
+                                        opts, handshake_cache, report,
+                                        checksums))
+
+    return run_sync(program_job(getattr(port, "port", None),
+                                SerialTransport(port), code, opts,
+                                handshake_cache, report, checksums))
+
+
+# Program against a session recorded with --record instead of a chip, with
+# the options it was recorded with; the replay went the same way if the
+# result is ok, conn.error is None and conn.finished()
+def replay_session(path, code, realtime=False, report=None):
+    conn = ReplayConn(path, realtime)
+    options = dict(conn.options)
+    # The reset magic bypasses the recorder
+    options["aispmagic"] = None
+    opts = job_options(options)
+    if not realtime:
+        # Nothing at the other end needs time
+        for profile in opts.timing.profiles.values():
+            for name in profile:
+                profile[name] = 0.0
+    checksums = block_checksums(code) if opts.verify else None
+    if report is None:
+        report = lambda event: None
+    result = run_sync(program_job(path, SerialTransport(conn), code, opts,
+                                  report=report, checksums=checksums))
+    return result, conn
+
+
+def job_options(options, base=None):
+    opts = dict(JOB_DEFAULTS, tracer=NULL_TRACER, flight_recorder=None,
+                record=None, latency=LatencyModel(), timing=Timing(),
+                serializer=None)
+    if base is not None:
+        opts.update(vars(base))
+    for key, value in options.items():
+        if key not in JOB_DEFAULTS:
+            raise ValueError("unknown option %s" % key)
+        if key == "protocol" and value is not None:
+            value = PROTOCOL_NAMES[value]
+        opts[key] = value
+    return argparse.Namespace(**opts)
+
+
+async def gang_worker(port, code, opts, transport_class, handshake_cache,
+                      checksums):
+    try:
+        conn = serial.Serial(port=port,
+                             baudrate=opts.lowbaud,
+                             parity=serial.PARITY_NONE)
+    except Exception as e:
+        result = Result(port)
+        result.error = str(e) or e.__class__.__name__
+        result.time = 0.0
+        return result
+
+    with conn:
+        return await program_job(port, transport_class(conn), code, opts,
+                                 handshake_cache, checksums=checksums)
+
+
+# All ports are served by one event loop where the platform allows
+# non-blocking serial ports, and by one thread per port elsewhere
+def gang_program(ports, code, opts, checksums=None):
+    handshake_cache = (HandshakeCache(opts.handshake_cache)
+                       if opts.handshake_cache else None)
+
+    if os.name == "posix":
+        async def run():
+            return list(await asyncio.gather(
+                *[gang_worker(port, code, opts, AsyncSerialTransport,
+                              handshake_cache, checksums)
+                  for port in ports]))
+        return asyncio.run(run())
+
+    results = [None] * len(ports)
+
+    def worker(idx, port):
+        results[idx] = run_sync(gang_worker(port, code, opts, SerialTransport,
+                                            handshake_cache, checksums))
+
+    threads = [threading.Thread(target=worker, args=(idx, port), name=port)
+               for idx, port in enumerate(ports)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+# Resident programmer taking jobs over a Unix domain socket.  Images stay
+# parsed in memory and ports stay open between jobs.  Each line received
+# is a JSON request, each line sent back a JSON event; "id", if given, is
+# copied into every event answering the request:
+#   {"cmd": "load", "image": "fw", "path": "fw.hex"}
+#   {"cmd": "program", "port": "/dev/ttyUSB0", "image": "fw",
+#    "options": {"highbaud": 460800, "sparse": true}}
+#   {"cmd": "unload", "image": "fw"}
+#   {"cmd": "close", "port": "/dev/ttyUSB0"}
+#   {"cmd": "status"}
+# A program request streams detect, handshake, erase, progress and done
+# events and ends with a result event.
+class Server:
+    def __init__(self, opts):
+        self.opts = opts
+        self.images = {}
+        self.ports = {}
+        self.handshake_cache = (HandshakeCache(opts.handshake_cache)
+                                if opts.handshake_cache else None)
+        self.image_cache = (ImageCache(opts.image_cache)
+                            if opts.image_cache else None)
+        self.commands = {"load": self.load,
+                         "unload": self.unload,
+                         "program": self.program,
+                         "close": self.close,
+                         "status": self.status}
+
+    async def serve(self, path):
+        if os.path.exists(path):
+            # A socket nobody answers on is left over from a server that
+            # died; one that answers belongs to a running server
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except (IOError, OSError):
+                os.unlink(path)
+            else:
+                writer.close()
+                raise IOError("%s 上已有服务在运行" % path)
+        umask = os.umask(0o077)
+        try:
+            server = await asyncio.start_unix_server(self.handle, path)
+        finally:
+            os.umask(umask)
+        os.chmod(path, 0o600)
+        logging.info("Serving on %s" % path)
+        loop = asyncio.get_event_loop()
+        try:
+            async with server:
+                serving = asyncio.ensure_future(server.serve_forever())
+                # Stop on SIGTERM as on Ctrl-C, so the ports are closed
+                # and the socket removed; only the main thread gets signals
+                main = threading.current_thread() is threading.main_thread()
+                if main:
+                    loop.add_signal_handler(signal.SIGTERM, serving.cancel)
+                try:
+                    await serving
+                except asyncio.CancelledError:
+                    logging.info("Stop serving on %s" % path)
+                finally:
+                    if main:
+                        loop.remove_signal_handler(signal.SIGTERM)
+        finally:
+            for port in list(self.ports):
+                self.close_port(port)
+            os.unlink(path)
+
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                request = json.loads(line.decode("utf-8"))
+                command = self.commands[request["cmd"]]
+            except (ValueError, KeyError, TypeError):
+                request = {}
+                command = None
+
+            def send(event, request=request):
+                if "id" in request:
+                    event["id"] = request["id"]
+                writer.write((json.dumps(event) + "\n").encode("utf-8"))
+
+            try:
+                if command is None:
+                    raise ValueError("bad request")
+                send(await command(request, send))
+            except Exception as e:
+                send({"event": "error",
+                      "error": str(e) or e.__class__.__name__})
+            await writer.drain()
+
+        writer.close()
+
+    async def load(self, request, send):
+        name = request.get("image", request["path"])
+        with open(request["path"], "rb") as f:
+            code = load_image(f, self.image_cache).flat()
+        self.images[name] = {"path": request["path"],
+                             "code": code,
+                             "checksums": block_checksums(code),
+                             "size": len(code),
+                             "digest": image_digest(code)}
+        logging.info("Image %s loaded from %s" % (name, request["path"]))
+        return {"event": "loaded", "image": name, "size": len(code),
+                "digest": self.images[name]["digest"]}
+
+    async def unload(self, request, send):
+        del self.images[request["image"]]
+        return {"event": "unloaded", "image": request["image"]}
+
+    async def program(self, request, send):
+        try:
+            image = self.images[request["image"]]
+        except KeyError:
+            raise ValueError("unknown image %s" % request.get("image"))
+
+        opts = job_options(request.get("options", {}), self.opts)
+
+        port = request["port"]
+        if port not in self.ports:
+            conn = serial.Serial(port=port,
+                                 baudrate=opts.lowbaud,
+                                 parity=serial.PARITY_NONE)
+            self.ports[port] = (conn, AsyncSerialTransport(conn),
+                                asyncio.Lock())
+        conn, transport, lock = self.ports[port]
+
+        async with lock:
+            transport.baudrate = opts.lowbaud
+            transport.flush_input()
+            result = await program_job(port, transport, image["code"], opts,
+                                       self.handshake_cache,
+                                       Throttle(lambda event:
+                                                send(event_dict(event))),
+                                       image["checksums"]
+                                       if opts.verify else None)
+            if not result.ok:
+                # Reopen the port for the next job in case it went away
+                self.close_port(port)
+
+        result = result.as_dict()
+        result["event"] = "result"
+        result["image"] = request["image"]
+        return result
+
+    async def close(self, request, send):
+        self.close_port(request["port"])
+        return {"event": "closed", "port": request["port"]}
+
+    def close_port(self, port):
+        entry = self.ports.pop(port, None)
+        if entry is not None:
+            entry[0].close()
+
+    async def status(self, request, send):
+        return {"event": "status",
+                "images": dict((name, {"path": image["path"],
+                                       "size": image["size"],
+                                       "digest": image["digest"]})
+                               for name, image in self.images.items()),
+                "ports": sorted(self.ports)}
+
+
+def print_gang_results(results, out=None):
+    if out is None:
+        out = sys.stdout
+
+    print("%-20s %-6s %-20s %-16s %-8s %-8s %s"
+          % ("端口", "结果", "型号", "序列号", "波特率", "检测", "耗时"),
+          file=out)
+    for r in results:
+        print("%-20s %-6s %-20s %-16s %-8s %-8s %.3fs%s"
+              % (r.port,
+                 "成功" if r.ok else "失败",
+                 r.model or "-",
+                 (r.serial or "-").upper(),
+                 r.baud or "-",
+                 "%.3fs" % r.detect if r.detect is not None else "-",
+                 r.time,
+                 ("  " + r.unit if r.unit is not None else "")
+                 + ("  " + r.error if r.error else "")), file=out)
+    print("成功: %d  失败: %d"
+          % (sum(1 for r in results if r.ok),
+             sum(1 for r in results if not r.ok)), file=out)
+
+
+# Code image as a sorted list of non-overlapping (address, data) segments,
+# plus the start address given by the HEX file, if any
+class Image:
+    def __init__(self, segments=None, start=None, flat=None):
+        self.segments = segments or []
+        self.start = start
+        self.__flat = flat
+
+    def __len__(self):
+        if not self.segments:
+            return 0
+        addr, data = self.segments[-1]
+        return addr + len(data)
+
+    # The whole image from address 0, gaps filled with 0xFF
+    def flat(self):
+        if self.__flat is None:
+            if len(self.segments) == 1 and self.segments[0][0] == 0:
+                self.__flat = self.segments[0][1]
+            else:
+                buf = bytearray(b"\xFF") * len(self)
+                for addr, data in self.segments:
+                    buf[addr:addr+len(data)] = data
+                self.__flat = buf
+        return self.__flat
+
+
+# Merge data chunks given in file order into sorted segments; where chunks
+# overlap, the later one wins
+def merge_segments(chunks):
+    segments = []
+    group = []
+    end = -1
+
+    def flush():
+        if len(group) == 1:
+            segments.append(chunks[group[0]])
+            return
+        lo = min(chunks[i][0] for i in group)
+        buf = bytearray(b"\xFF") * (end - lo)
+        for i in sorted(group):
+            addr, data = chunks[i]
+            buf[addr-lo:addr-lo+len(data)] = data
+        segments.append((lo, buf))
+
+    for i in sorted(range(len(chunks)), key=lambda i: chunks[i][0]):
+        addr, data = chunks[i]
+        if group and addr > end:
+            flush()
+            group = []
+        group.append(i)
+        end = max(end, addr + len(data))
+    if group:
+        flush()
+
+    return segments
+
+
+# Parse Intel HEX code in one pass
+def parse_hex(code):
+    chunks = []
+    chunk = None
+    chunk_end = -1
+    base = 0
+    start = None
+
+    for line, rec in enumerate(code.splitlines(), 1):
+        rec = rec.strip()
+        if not rec:
+            continue
 
         if rec[0] != ord(":"):
             raise Exception("Line %d: Missing start code \":\"" % line)
+        try:
+            dat = binascii.a2b_hex(rec[1:])
+        except (TypeError, ValueError):
+            raise Exception("Line %d: Invalid format" % line)
+
+        n = len(dat) - 5
+        if n < 0 or dat[0] != n:
+            raise Exception("Line %d: Invalid format" % line)
         if sum(dat) & 0xFF != 0:
             raise Exception("Line %d: Incorrect checksum" % line)
 
         if dat[3] == 0:      # Data record
             addr = base + (dat[1] << 8) + dat[2]
-            # Allocate memory space and fill it with 0xFF
-            buf[len(buf):] = [0xFF] * (addr + n - len(buf))
-            # Copy data to the buffer
-            buf[addr:addr+n] = dat[4:-1]
+            if addr == chunk_end:
+                chunk += dat[4:-1]
+            else:
+                chunk = bytearray(dat[4:-1])
+                chunks.append((addr, chunk))
+            chunk_end = addr + n
 
         elif dat[3] == 1:    # EOF record
             if n != 0:
                 raise Exception("Line %d: Incorrect data length" % line)
+            break
 
         elif dat[3] == 2:    # Extended segment address record
             if n != 2:
                 raise Exception("Line %d: Incorrect data length" % line)
             base = ((dat[4] << 8) + dat[5]) << 4
 
+        elif dat[3] == 3:    # Start segment address record (CS:IP)
+            if n != 4:
+                raise Exception("Line %d: Incorrect data length" % line)
+            start = (((dat[4] << 8) + dat[5]) << 4) + (dat[6] << 8) + dat[7]
+
         elif dat[3] == 4:    # Extended linear address record
             if n != 2:
                 raise Exception("Line %d: Incorrect data length" % line)
             base = ((dat[4] << 8) + dat[5]) << 16
 
+        elif dat[3] == 5:    # Start linear address record
+            if n != 4:
+                raise Exception("Line %d: Incorrect data length" % line)
+            start = struct.unpack(">I", dat[4:8])[0]
+
         else:
             raise Exception("Line %d: Unsupported record type" % line)
 
-    return buf
+    return Image(merge_segments(chunks), start)
+
+
+# Convert Intel HEX code to binary format
+def hex2bin(code):
+    return parse_hex(code).flat()
+
+
+# Parsed HEX images kept on disk, so that a file flashed again and again is
+# only parsed once.  An entry is found by the path, size and mtime of the
+# source file and holds the SHA-256 of the source, the segment map and the
+# flat image, which is memory-mapped when loaded.
+class ImageCache:
+    def __init__(self, directory, size=IMAGE_CACHE_SIZE):
+        self.directory = directory
+        self.size = size
+
+    # Entries are named after the digest of the source with its size and
+    # mtime; hashing the source costs far less than parsing it
+    def __entry(self, path, digest):
+        st = os.stat(path)
+        key = "%s\0%d\0%d" % (digest, st.st_size, st.st_mtime_ns)
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest() + ".img"
+        return os.path.join(self.directory, name)
+
+    def load(self, path, source):
+        digest = hashlib.sha256(source).hexdigest()
+        try:
+            entry = self.__entry(path, digest)
+            with open(entry, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            if data[:len(IMAGE_CACHE_MAGIC)] != IMAGE_CACHE_MAGIC:
+                raise ValueError()
+            pos = len(IMAGE_CACHE_MAGIC)
+            n = struct.unpack(">I", data[pos:pos+4])[0]
+            header = json.loads(data[pos+4:pos+4+n].decode("utf-8"))
+            if header["digest"] != digest:
+                raise ValueError()
+            pos += 4 + n
+            flat = memoryview(data)[pos:pos+header["length"]]
+            segments = [(addr, flat[addr:addr+size])
+                        for addr, size in header["segments"]]
+        except (ValueError, KeyError, struct.error):
+            logging.info("Ignore broken image cache entry %s" % entry)
+            return None
+
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        logging.info("Image loaded from cache %s" % entry)
+        return Image(segments, header["start"], flat)
+
+    def store(self, path, image, source):
+        flat = image.flat()
+        header = {"source": os.path.realpath(path),
+                  "digest": hashlib.sha256(source).hexdigest(),
+                  "start": image.start,
+                  "length": len(flat),
+                  "segments": [(addr, len(data))
+                               for addr, data in image.segments]}
+        digest = header["digest"]
+        header = json.dumps(header).encode("utf-8")
+
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            atomic_write(self.__entry(path, digest),
+                         IMAGE_CACHE_MAGIC + struct.pack(">I", len(header))
+                         + header + bytes(flat))
+            self.__evict()
+        except (IOError, OSError) as e:
+            logging.info("Cannot write image cache: %s" % e)
+
+    def __evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+
+        # Drop the least recently used entries beyond the size cap
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.size:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+
+# Load a code image.  A .bin is mapped rather than read only when mapped
+# is set, for a single download that ends with the command: a mapping that
+# outlives it would see a rebuild of the file change under it, or fault if
+# it shrinks
+def load_image(f, cache=None, mapped=False):
+    if os.path.splitext(f.name)[1] in (".hex", ".ihx"):
+        source = f.read()
+        if cache is not None:
+            image = cache.load(f.name, source)
+            if image is not None:
+                return image
+
+        image = parse_hex(source)
+        if cache is not None:
+            cache.store(f.name, image, source)
+        return image
+
+    data = None
+    if mapped:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError, AttributeError, io.UnsupportedOperation):
+            pass
+    if data is None:
+        data = bytearray(f.read())
+    return Image([(0, data)] if len(data) else [])
+
 
 def stc_type_map(type, value):  
     if type == 0xF6:      
@@ -1316,6 +2994,388 @@ def stc_type_map(type, value):
             return  0xF2A0
     
 
+MODEL_MAP = {0xE0: ("12", 1, {(0x00, 0x1F): ("C54", ""),
+                              (0x60, 0x7F): ("C54", "AD"),
+                              (0x80, 0x9F): ("LE54", ""),
+                              (0xE0, 0xFF): ("LE54", "AD"),
+                              }),
+             0xE1: ("12", 1, {(0x00, 0x1F): ("C52", ""),
+                              (0x20, 0x3F): ("C52", "PWM"),
+                              (0x60, 0x7F): ("C52", "AD"),
+                              (0x80, 0x9F): ("LE52", ""),
+                              (0xA0, 0xBF): ("LE52", "PWM"),
+                              (0xE0, 0xFF): ("LE52", "AD"),
+                              }),
+             0xE2: ("11", 1, {(0x00, 0x1F): ("F", ""),
+                              (0x20, 0x3F): ("F", "E"),
+                              (0x70, 0x7F): ("F", ""),
+                              (0x80, 0x9F): ("L", ""),
+                              (0xA0, 0xBF): ("L", "E"),
+                              (0xF0, 0xFF): ("L", ""),
+                              }),
+             0xE6: ("12", 1, {(0x00, 0x1F): ("C56", ""),
+                              (0x60, 0x7F): ("C56", "AD"),
+                              (0x80, 0x9F): ("LE56", ""),
+                              (0xE0, 0xFF): ("LE56", "AD"),
+                              }),
+             0xD1: ("12", 2, {(0x20, 0x3F): ("C5A", "CCP"),
+                              (0x40, 0x5F): ("C5A", "AD"),
+                              (0x60, 0x7F): ("C5A", "S2"),
+                              (0xA0, 0xBF): ("LE5A", "CCP"),
+                              (0xC0, 0xDF): ("LE5A", "AD"),
+                              (0xE0, 0xFF): ("LE5A", "S2"),
+                              }),
+             0xD2: ("10", 1, {(0x00, 0x0F): ("F", ""),
+                              (0x60, 0x6F): ("F", "XE"),
+                              (0x70, 0x7F): ("F", "X"),
+                              (0xA0, 0xAF): ("L", ""),
+                              (0xE0, 0xEF): ("L", "XE"),
+                              (0xF0, 0xFF): ("L", "X"),
+                              }),
+             0xD3: ("11", 2, {(0x00, 0x1F): ("F", ""),
+                              (0x40, 0x5F): ("F", "X"),
+                              (0x60, 0x7F): ("F", "XE"),
+                              (0xA0, 0xBF): ("L", ""),
+                              (0xC0, 0xDF): ("L", "X"),
+                              (0xE0, 0xFF): ("L", "XE"),
+                              }),
+             0xF0: ("89", 4, {(0x00, 0x10): ("C5", "RC"),
+                              (0x20, 0x30): ("C5", "RC"),  #STC90C5xRC
+                              }),
+             0xF1: ("89", 4, {(0x00, 0x10): ("C5", "RD+"),
+                              (0x20, 0x30): ("C5", "RD+"),  #STC90C5xRD+
+                              }),
+             0xF2: ("12", 1, {(0x00, 0x0F): ("C", "052"),
+                              (0x10, 0x1F): ("C", "052AD"),
+                              (0x20, 0x2F): ("LE", "052"),
+                              (0x30, 0x3F): ("LE", "052AD"),
+                              }),
+             0xF2A0: ("15W", 1, {(0xA0, 0xA5): ("1", ""),   #STC15W1系列
+                              }),
+             0xF400: ("15F", 8, {(0x00, 0x07): ("2K", "S2"),   #STC15F2K系列
+                              }),
+             0xF407: ("15F", 60, {(0x07, 0x08): ("2K", "S2"),   #STC15F2K系列
+                              }),
+             0xF408: ("15F", 61, {(0x08, 0x09): ("2K", "S2"),   #STC15F2K系列
+                              }),
+             0xF400: ("15F", 4, {(0x09, 0x0C): ("4", "AD"),   #STC15FAD系列
+                              }),
+             0xF410: ("15F", 8, {(0x10, 0x17): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF417: ("15F", 60, {(0x17, 0x18): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF418: ("15F", 61, {(0x18, 0x19): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF420: ("15F", 8, {(0x20, 0x27): ("1K", "S"),   #STC15F1KS系列
+                              }),
+             0xF427: ("15F", 60, {(0x27, 0x28): ("1K", "S"),   #STC15F1KS系列
+                              }),
+             0xF440: ("15F", 8, {(0x40, 0x47): ("1K", "S2"),   #STC15F1KS2系列
+                              }),
+             0xF447: ("15F", 60, {(0x47, 0x48): ("1K", "S2"),   #STC15F1KS2系列
+                              }),
+             0xF448: ("15F", 61, {(0x48, 0x49): ("1K", "S2"),   #STC15F1KS2系列
+                              }),
+             0xF44C: ("15F", 13, {(0x4C, 0x4D): ("4", "AD"),  
+                              }),
+             0xF450: ("15F", 8, {(0x50, 0x57): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF457: ("15F", 60, {(0x57, 0x58): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF458: ("15F", 61, {(0x58, 0x59): ("1K", "AS"),   #STC15F1KAS系列
+                              }),
+             0xF460: ("15F", 8, {(0x60, 0x67): ("1K", "S"),   #STC15F1KS系列
+                              }),
+             0xF467: ("15F", 60, {(0x67, 0x68): ("1K", "S"),   #STC15F1KS系列
+                              }),
+             0xF468: ("15F", 61, {(0x68, 0x69): ("1K", "S"),   #STC15F1KS系列
+                              }),
+             0xF480: ("15L", 8, {(0x80, 0x87): ("2K", "S2"),   #STC15L2KS2系列
+                              }),
+             0xF487: ("15L", 60, {(0x87, 0x88): ("2K", "S2"),   #STC15L2KS2系列
+                              }),
+             0xF488: ("15L", 61, {(0x88, 0x89): ("2K", "S2"),   #STC15L2KS2系列
+                              }),
+             0xF489: ("15L", 5, {(0x89, 0x8C): ("4", "AD"),   #STC15L4AD系列
+                              }),
+             0xF490: ("15L", 8, {(0x90, 0x97): ("2K", "AS"),   #STC15L2KAS系列
+                              }),
+             0xF497: ("15L", 60, {(0x97, 0x98): ("2K", "AS"),   #STC15L2KAS系列
+                              }),
+             0xF498: ("15L", 61, {(0x98, 0x99): ("2K", "AS"),   #STC15L2KAS系列
+                              }),
+             0xF4A0: ("15L", 8, {(0xA0, 0xA7): ("2K", "S"),   #STC15L2KS系列
+                              }),
+             0xF4A7: ("15L", 60, {(0xA7, 0xA8): ("2K", "S"),   #STC15L2KS系列
+                              }),
+             0xF4A8: ("15L", 61, {(0xA8, 0xA9): ("2K", "S"),   #STC15L2KS系列
+                              }),
+             0xF4C0: ("15L", 8, {(0xC0, 0xC7): ("1K", "S2"),   #STC15L1KS2系列
+                              }),
+             0xF4C7: ("15L", 60, {(0xC7, 0xC8): ("1K", "S2"),   #STC15L1KS2系列
+                              }),
+             0xF4C8: ("15L", 61, {(0xC8, 0xC9): ("1K", "S2"),   #STC15L1KS2系列
+                              }),
+             0xF4CC: ("15L", 13, {(0xCC, 0xCD): ("4", "AD"),   
+                              }),
+             0xF4D0: ("15L", 8, {(0xD0, 0xD7): ("1K", "AS"),   #STC15L1KS2系列
+                              }),
+             0xF4D7: ("15L", 60, {(0xD7, 0xD8): ("1K", "AS"),   #STC15L1KS2系列
+                              }),
+             0xF4D8: ("15L", 61, {(0xD8, 0xD9): ("1K", "AS"),   #STC15L1KS2系列
+                              }),
+             0xF4E0: ("15L", 8, {(0xE0, 0xE7): ("1K", "S"),   #STC15L1KS系列
+                              }),
+             0xF4E7: ("15L", 60, {(0xE7, 0xE8): ("1K", "S"),   #STC15L1KS系列
+                              }),
+             0xF4E8: ("15L", 61, {(0xE8, 0xE9): ("1K", "S"),   #STC15L1KS系列
+                              }),
+             0xF500: ("15W", 1, {(0x00, 0x04): ("1", "SW"),   #STC15W1SW系列
+                              }),
+             0xF507: ("15W", 1, {(0x07, 0x0B): ("1", "S"),   #STC15W1S系列
+                              }),
+             0xF510: ("15W", 1, {(0x10, 0x14): ("2", "S"),   #STC15W2S系列
+                              }),
+             0xF514: ("15W", 8, {(0x14, 0x17): ("1K", "S"),   #STC15W1KS系列
+                              }),
+             0xF518: ("15W", 4, {(0x18, 0x1A): ("4", "S"),   #STC15W4S系列
+                              }),
+             0xF51A: ("15W", 4, {(0x1A, 0x1C): ("4", "S"),   #STC15W4S系列
+                              }),
+             0xF51C: ("15W", 4, {(0x1C, 0x1F): ("4", "AS"),   #STC15W4AS系列
+                              }),
+             0xF51F: ("15W", 10, {(0x19, 0x20): ("4", "AS"),   #STC15W4AS系列
+                              }),
+             0xF520: ("15W", 12, {(0x20, 0x21): ("4", "AS"),   #STC15W4AS系列
+                              }),
+             0xF522: ("15W", 16, {(0x22, 0x23): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF523: ("15W",24, {(0x23, 0x24): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF524: ("15W", 32, {(0x24, 0x25): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF525: ("15W", 40, {(0x25, 0x26): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF526: ("15W", 48, {(0x26, 0x27): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF527: ("15W", 56, {(0x27, 0x28): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF529: ("15W", 1, {(0x29, 0x2B): ("4", "A4"),   #STC15W4AS系列
+                              }),
+             0xF52C: ("15W", 8, {(0x2C, 0x2E): ("1K", "PWM"),   #STC15W1KPWM系列
+                              }),
+             0xF52E: ("15W", 20, {(0x2E, 0x2F): ("1K", "S"),   #STC15W1KS系列
+                              }),
+             0xF52F: ("15W", 32, {(0x2F, 0x30): ("2K", "S2"),   #STC15W2KS2系列
+                              }),
+             0xF530: ("15W", 48, {(0x30, 0x31): ("2K", "S2"),   #STC15W2KS2系列
+                              }),
+             0xF531: ("15W", 32, {(0x31, 0x32): ("2K", "S2"),   #STC15W2KS2系列
+                              }),
+             0xF533: ("15W", 20, {(0x33, 0x34): ("1K", "S2"),   #STC15W1KS2系列
+                              }),
+             0xF534: ("15W", 32, {(0x34, 0x35): ("1K", "S2"),   #STC15W1KS2系列
+                              }),
+             0xF535: ("15W", 48, {(0x35, 0x36): ("1K", "S2"),   #STC15W1KS2系列
+                              }),
+             0xF544: ("15W", 5, {(0x44, 0x45): ("", "SW"),   #STC15SW系列
+                              }),
+             0xF554: ("15W", 5, {(0x54, 0x55): ("2", "S"),   #STC15W2S系列
+                              }),
+             0xF557: ("15W", 29, {(0x57, 0x58): ("1K", "S"),   #STC15W1KS系列
+                              }),
+             0xF55C: ("15W", 13, {(0x5C, 0x5D): ("4", "S"),   #STC15W4S系列
+                              }),
+             0xF568: ("15W", 58, {(0x68, 0x69): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF569: ("15W", 61, {(0x69, 0x6A): ("4K", "S4"),   #STC15W4KS4系列
+                              }),
+             0xF56C: ("15W", 58, {(0x6C, 0x6D): ("4K", "S4-Student"),   #STC15W4KS4系列
+                              }),
+             0xF57E: ("15U", 8, {(0x7E, 0x85): ("4K", "S4"),   #STC15U4KS4系列
+                              }),
+             0xF600: ("15H", 8, {(0x00, 0x08): ("4K", "S4"),   #STC154K系列
+                              }),
+             0xF620: ("8A", 8, {(0x20, 0x28): ("8K", "S4A12"),   #STC8A8K系列
+                              }),
+             0xF628: ("8A", 60, {(0x28, 0x29): ("8K", "S4A12"),   #STC8A8K系列
+                              }),
+             0xF630: ("8F", 8, {(0x30, 0x38): ("2K", "S4"),   #STC8F2K系列
+                              }),
+             0xF638: ("8F", 60, {(0x38, 0x39): ("2K", "S4"),   #STC8F2K系列
+                              }),
+             0xF640: ("8F", 8, {(0x40, 0x48): ("2K", "S2"),   #STC8F2K系列
+                              }),
+             0xF648: ("8F", 60, {(0x48, 0x49): ("2K", "S2"),   #STC8F2K系列
+                              }),
+             0xF650: ("8A", 8, {(0x50, 0x58): ("4K", "S2A12"),   #STC8A4K系列
+                              }),
+             0xF658: ("8A", 60, {(0x58, 0x59): ("4K", "S2A12"),   #STC8A4K系列
+                              }),
+             0xF660: ("8F", 2, {(0x60, 0x66): ("1K", "S2"),   #STC8F1K系列
+                              }),
+             0xF666: ("8F", 17, {(0x66, 0x67): ("1K", "S2"),   #STC8F1K系列
+                              }),
+             0xF670: ("8F", 2, {(0x70, 0x76): ("1K", ""),   #STC8F1K系列
+                              }),
+             0xF676: ("8F", 17, {(0x76, 0x77): ("1K", ""),   #STC8F1K系列
+                              }),
+             0xF700: ("8C", 2, {(0x00, 0x06): ("1K", ""),   #STC8C系列
+                              }),   
+             0xF730: ("8H", 2, {(0x30, 0x36): ("1K", ""),   #STC8H1K系列
+                              }),
+             0xF736: ("8H", 17, {(0x36, 0x37): ("1K", ""),   #STC8H1K系列
+                              }),
+             0xF740: ("8H", 8, {(0x40, 0x42): ("3K", "S4"),   #STC8H3K系列
+                              }),
+             0xF742: ("8H", 60, {(0x42, 0x43): ("3K", "S4"),   #STC8H3K系列
+                              }),
+             0xF743: ("8H", 64, {(0x43, 0x44): ("3K", "S4"),   #STC8H3K系列
+                              }),
+             0xF748: ("8H", 16, {(0x48, 0x4A): ("3K", "S2"),   #STC8H3K系列
+                              }),
+             0xF74A: ("8H", 60, {(0x4A, 0x4B): ("3K", "S2"),   #STC8H3K系列
+                              }),
+             0xF74B: ("8H", 64, {(0x4B, 0x4C): ("3K", "S2"),   #STC8H3K系列
+                              }),
+             0xF750: ("8G", 2, {(0x50, 0x56): ("1K", "-20/16pin"),   #STC8G1K系列
+                              }),
+             0xF756: ("8G", 17, {(0x56, 0x57): ("1K", "-20/16pin"),   #STC8G1K系列
+                              }),
+             0xF760: ("8G", 16, {(0x60, 0x62): ("2K", "S4"),   #STC8G2K系列
+                              }),
+             0xF762: ("8G", 60, {(0x62, 0x63): ("2K", "S4"),   #STC8G2K系列
+                              }),
+             0xF763: ("8G", 64, {(0x63, 0x64): ("2K", "S4"),   #STC8G2K系列
+                              }),
+             0xF768: ("8G", 16, {(0x68, 0x6A): ("2K", "S2"),   #STC8G2K系列
+                              }),
+             0xF76A: ("8G", 60, {(0x6A, 0x6B): ("2K", "S2"),   #STC8G2K系列
+                              }),
+             0xF76B: ("8G", 64, {(0x6B, 0x6C): ("2K", "S2"),   #STC8G2K系列
+                              }),
+             0xF770: ("8G", 2, {(0x70, 0x76): ("1K", "T"),   #STC8G2K系列
+                              }),
+             0xF776: ("8G", 17, {(0x76, 0x77): ("1K", "T"),   #STC8G2K系列
+                              }),
+             0xF780: ("8H", 16, {(0x80, 0x82): ("8K", "U"),   #STC8H8K系列
+                              }),
+             0xF782: ("8H", 60, {(0x82, 0x83): ("8K", "U"),   #STC8H8K系列
+                              }),
+             0xF783: ("8H", 64, {(0x83, 0x84): ("8K", "U"),   #STC8H8K系列
+                              }),
+             0xF790: ("8G", 2, {(0x90, 0x96): ("1K", "A-8PIN"),   #STC8G1K系列
+                              }),
+             0xF796: ("8G", 17, {(0x96, 0x97): ("1K", "A-8PIN"),   #STC8G1K系列
+                              }),
+             0xF7A0: ("8G", 2, {(0xA0, 0xA6): ("1K", "-8PIN"),   #STC8G1K系列
+                              }),
+             0xF7A6: ("8G", 17, {(0xA6, 0xA7): ("1K", "-8PIN"),   #STC8G1K系列
+                              }),
+             }
+
+IAP_MCU = ((0xD1, 0x3F), (0xD1, 0x5F), (0xD1, 0x7F), (0xF4, 0x4D), (0xF4, 0x99), (0xF4, 0xD9), (0xF5, 0x58), 
+           (0xD2, 0x7E), (0xD2, 0xFE), (0xF4, 0x09), (0xF4, 0x59), (0xF4, 0xA9), (0xF4, 0xE9), (0xF5, 0x5D), 
+           (0xD3, 0x5F), (0xD3, 0xDF), (0xF4, 0x19), (0xF4, 0x69), (0xF4, 0xC9), (0xF5, 0x45), (0xF5, 0x62),
+           (0xE2, 0x76), (0xE2, 0xF6), (0xF4, 0x49), (0xF4, 0x89), (0xF4, 0xCD), (0xF5, 0x55), (0xF5, 0x69),
+           (0xF5, 0x6A), (0xF5, 0x6D),
+           )
+
+MODEL_PROTOCOLS = {0xF0: PROTOCOL_89,       #STC89/90C5xRC
+                  0xF1: PROTOCOL_89,       #STC89/90C5xRD+
+                  0xF2: PROTOCOL_12Cx052,  #STC12Cx052
+                  0xD1: PROTOCOL_12C5A,    #STC12C5Ax
+                  0xD2: PROTOCOL_12C5A,    #STC10Fx
+                  0xE1: PROTOCOL_12C52,    #STC12C52x
+                  0xE2: PROTOCOL_12C5A,    #STC11Fx
+                  0xE6: PROTOCOL_12C52,    #STC12C56x
+                  0xF4: PROTOCOL_15,    #STC15系列
+                  0xF5: PROTOCOL_15,    #STC15系列
+                  0xF6: PROTOCOL_8,  #STC8系列
+                  0xF7: PROTOCOL_8,  #STC8系列
+                  }
+
+
+# Resolve a model ID to its name and flash size in KB
+def resolve_model(model):
+    try:
+        model = tuple(model) 
+        if model[0] in [0xF4, 0xF5, 0xF6, 0xF7]:
+            prefix, romratio, fixmap = MODEL_MAP[stc_type_map(model[0],model[1])]
+        elif model[0] == 0xF2 and model[1] in range(0xA0, 0xA6):
+            prefix, romratio, fixmap = MODEL_MAP[stc_type_map(model[0],model[1])]
+        else:
+            prefix, romratio, fixmap = MODEL_MAP[model[0]]
+
+        if model[0] in (0xF0, 0xF1) and 0x20 <= model[1] <= 0x30:
+            prefix = "90" 
+
+        for key, value in fixmap.items():
+            if key[0] <= model[1] <= key[1]:
+                break
+        else:
+            raise KeyError()
+
+        infix, postfix = value
+
+        romsize = romratio * (model[1] - key[0])
+
+        try:
+            romsize = {(0xF0, 0x03): 13}[model]
+        except KeyError:
+            pass
+
+        if model[0] in (0xF0, 0xF1):
+            romfix = str(model[1] - key[0])
+        elif model[0] in (0xF2,):
+            romfix = str(romsize)
+        else:
+            romfix = "%02d" % romsize
+
+        name = "IAP" if model in IAP_MCU else "STC"
+        name += prefix + infix + romfix + postfix
+        return (name, romsize)
+
+    except KeyError:
+        return None
+
+
+def build_model_index():
+    index = {}
+    for first in set((key >> 8) or key for key in MODEL_MAP):
+        for second in range(0x100):
+            found = resolve_model((first, second))
+            if found is not None:
+                index[(first, second)] = found
+    return index
+
+
+# All known (model[0], model[1]) -> (name, romsize), built once at import
+MODEL_INDEX = build_model_index()
+
+
+def model_protocol(first, second):
+    if first == 0xF2 and 0xA0 <= second < 0xA6:
+        return PROTOCOL_15
+    return MODEL_PROTOCOLS.get(first)
+
+
+def lookup_model(first, second):
+    try:
+        return MODEL_INDEX[(first, second)]
+    except KeyError:
+        return ("Unknown %02X %02X" % (first, second), None)
+
+
+def list_models():
+    return [{"id": "%02X%02X" % key,
+             "model": list(key),
+             "name": name,
+             "romsize": romsize,
+             "protocol": model_protocol(*key)}
+            for key, (name, romsize) in sorted(MODEL_INDEX.items())]
+
+
 def main(): 
  
     if sys.platform == "win32":
@@ -1325,6 +3385,15 @@ def main():
     else:
         port = "/dev/ttyUSB0"
 
+    # "stcflash.py serve [options]" runs the resident server instead,
+    # "stcflash.py calibrate [image] [options]" the timing calibration and
+    # "stcflash.py replay image --record FILE" a recorded session
+    argv = sys.argv[1:]
+    command = None
+    if argv[:1] in (["serve"], ["calibrate"], ["replay"]):
+        command = argv[0]
+        argv = argv[1:]
+
     parser = argparse.ArgumentParser(
         description=("Stcflash, a command line programmer for "
                      + "STC 8051 microcontroller.\n"
@@ -1335,14 +3404,33 @@ def main():
     parser.add_argument("-p", "--port",
                         help="serial port device (default: %s)" % port,
                         default=port)
+    parser.add_argument("-g", "--gang",
+                        help=("program serial ports in parallel; a port "
+                              + "name, comma separated list or glob pattern "
+                              + "such as \"/dev/ttyUSB*\" (repeatable)"),
+                        action="append",
+                        metavar="PORTS")
     parser.add_argument("-l", "--lowbaud",
                         help="initial baud rate (default: 2400)",
                         type=int,
                         default=2400)
     parser.add_argument("-hb", "--highbaud",
-                        help="initial baud rate (default: 115200)",
+                        help=("highest baud rate to try, slower standard "
+                              + "rates are tried if it fails (default: 115200)"),
                         type=int,
                         default=115200)
+    parser.add_argument("--detect-timeout",
+                        help="seconds to wait for the target (default: %g)"
+                        % DETECT_TIMEOUT,
+                        type=float,
+                        default=DETECT_TIMEOUT)
+    parser.add_argument("--sync-interval",
+                        help=("milliseconds between sync pulses while "
+                              + "detecting (default: twice the pulse length "
+                              + "at the low baud rate, at least %g)"
+                              % (DETECT_MIN_INTERVAL * 1000)),
+                        type=float,
+                        metavar="MS")
     parser.add_argument("-r", "--protocol",
                         help="protocol to use for programming",
                         choices=["89", "12c5a", "12c52", "12cx052", "8", "15", "auto"],
@@ -1353,6 +3441,96 @@ def main():
                         default=4800)
     parser.add_argument("-m", "--aispmagic",
                         help="magic word for AutoISP")
+    parser.add_argument("-s", "--sparse",
+                        help=("skip code blocks that are entirely 0xFF "
+                              + "(not STC89)"),
+                        action="store_true")
+    parser.add_argument("--verify",
+                        help=("check every block against the checksum or "
+                              + "status returned by the target and rewrite "
+                              + "blocks that fail"),
+                        action="store_true")
+    parser.add_argument("--resume",
+                        help=("times to wait for the target to come back "
+                              + "and continue from the last written block "
+                              + "after the download breaks off (default: 0)"),
+                        type=int,
+                        default=0)
+    parser.add_argument("--loop",
+                        help=("keep programming: after each chip, wait for "
+                              + "the next one on the same port"),
+                        action="store_true")
+    parser.add_argument("--handshake-cache",
+                        help=("remember the baud rate that worked for each "
+                              + "port, model and clock in this file "
+                              + "(89/12C series)"),
+                        metavar="FILE")
+    parser.add_argument("--latency-model",
+                        help=("measure how fast the target answers and keep "
+                              + "the slowest answers in this file; receive "
+                              + "timeouts are derived from them"),
+                        metavar="FILE")
+    parser.add_argument("--timing-profile",
+                        help=("delays of each protocol family, as found by "
+                              + "\"stcflash.py calibrate\"; written by it"),
+                        metavar="FILE")
+    parser.add_argument("--calibrate-runs",
+                        help=("downloads at every step of \"calibrate\" "
+                              + "(default: %d)" % CALIBRATE_RUNS),
+                        type=int,
+                        default=CALIBRATE_RUNS)
+    parser.add_argument("--flight-recorder",
+                        help=("keep the last raw transfers in memory and save "
+                              + "them to this directory if programming fails"),
+                        metavar="DIR")
+    parser.add_argument("--serial-addr",
+                        help=("write per-unit data (serial number, MAC, "
+                              + "calibration) into the code at this address"),
+                        type=lambda s: int(s, 0),
+                        metavar="ADDR")
+    parser.add_argument("--serial-format",
+                        help=("struct format such as \"<I\", \"hex\" for "
+                              + "hex digits from --serial-csv, or a %% "
+                              + "format such as \"SN%%08d\" for text "
+                              + "(default: <I)"),
+                        default="<I",
+                        metavar="FMT")
+    parser.add_argument("--serial-counter",
+                        help=("file holding the next counter value, or the "
+                              + "next row of --serial-csv; advanced before "
+                              + "each chip is programmed"),
+                        metavar="FILE")
+    parser.add_argument("--serial-csv",
+                        help="take the per-unit values from rows of this file",
+                        metavar="FILE")
+    parser.add_argument("--serial-start",
+                        help=("counter value if --serial-counter does not "
+                              + "exist yet (default: 0)"),
+                        type=int,
+                        metavar="N",
+                        default=0)
+    parser.add_argument("--record",
+                        help=("save every transfer of the session to this "
+                              + "file; \"stcflash.py replay\" plays it back"),
+                        metavar="FILE")
+    parser.add_argument("--realtime",
+                        help="replay a session at the recorded pace",
+                        action="store_true")
+    parser.add_argument("--trace",
+                        help=("write timed spans of every phase, block and "
+                              + "wait to this file in Chrome trace format"),
+                        metavar="FILE")
+    parser.add_argument("--image-cache",
+                        help=("keep parsed HEX images in this directory and "
+                              + "reuse them while the file is unchanged"),
+                        metavar="DIR")
+    parser.add_argument("--socket",
+                        help=("Unix socket of the \"serve\" mode (default: "
+                              + "%s)" % SERVER_SOCKET),
+                        default=SERVER_SOCKET)
+    parser.add_argument("--list-models",
+                        help="print the known model IDs as JSON and exit",
+                        action="store_true")
     parser.add_argument("-v", "--verbose",
                         help="be verbose",
                         default=0,
@@ -1366,19 +3544,18 @@ def main():
                               +"(experimental)"),
                         action="store_true")
 
-    opts = parser.parse_args()
+    opts = parser.parse_args(argv)
+
+    if opts.list_models:
+        json.dump(list_models(), sys.stdout, indent=1)
+        sys.stdout.write("\n")
+        return
 
     opts.loglevel = (logging.CRITICAL,
                      logging.INFO,
                      logging.DEBUG)[min(2, opts.verbose)]
 
-    opts.protocol = {'89': PROTOCOL_89,
-                     '12c5a': PROTOCOL_12C5A,
-                     '12c52': PROTOCOL_12C52,
-                     '12cx052': PROTOCOL_12Cx052,
-                     '8': PROTOCOL_8,  
-                     '15': PROTOCOL_15, 
-                     'auto': None}[opts.protocol]
+    opts.protocol = PROTOCOL_NAMES[opts.protocol]
 
     if not opts.erase_eeprom and not opts.not_erase_eeprom:
         opts.erase_eeprom = None
@@ -1388,24 +3565,116 @@ def main():
                                 + "%(message)s"),
                         level=opts.loglevel)
 
+    opts.tracer = Tracer(opts.trace) if opts.trace else NULL_TRACER
+    opts.latency = LatencyModel(opts.latency_model)
+    opts.timing = Timing(opts.timing_profile)
+
+    opts.serializer = None
+    if opts.serial_addr is not None:
+        if not opts.serial_counter:
+            parser.error("--serial-addr needs --serial-counter FILE")
+        try:
+            opts.serializer = Serializer(opts.serial_addr, opts.serial_format,
+                                         opts.serial_counter,
+                                         load_rows(opts.serial_csv)
+                                         if opts.serial_csv else None,
+                                         opts.serial_start)
+        except (IOError, ValueError) as e:
+            parser.error(str(e))
+    try:
+        run(parser, opts, command)
+    finally:
+        if opts.trace:
+            opts.tracer.close()
+
+
+def run(parser, opts, command):
+    if opts.record and (opts.gang or opts.loop or command == "serve"):
+        parser.error("--record needs a single download")
+
+    if command == "serve":
+        try:
+            asyncio.run(Server(opts).serve(opts.socket))
+        except KeyboardInterrupt:
+            pass
+        except IOError as e:
+            parser.error(str(e))
+        return
+
     if opts.image:
-        code = bytearray(opts.image.read())
+        with opts.tracer.track("stcflash").span("load image"):
+            code = load_image(opts.image,
+                              ImageCache(opts.image_cache)
+                              if opts.image_cache else None,
+                              not opts.loop and not opts.gang).flat()
         opts.image.close()
-        if os.path.splitext(opts.image.name)[1] in (".hex", ".ihx"):
-            code = hex2bin(code)
     else:
         code = None
 
+    # Computed once for the image, however many chips are programmed
+    checksums = (block_checksums(code)
+                 if opts.verify and code is not None else None)
+
+    if opts.loop and (opts.gang or code is None):
+        parser.error("--loop needs a code image and a single port")
+
+    if command == "replay":
+        if not opts.record or code is None:
+            parser.error("replay needs a code image and --record FILE")
+        result, conn = replay_session(opts.record, code, opts.realtime,
+                                      Throttle(ConsoleReport()))
+        if conn.error is not None or not result.ok or not conn.finished():
+            print("回放不一致: %s"
+                  % (conn.error or result.error
+                     or "记录中还有 %d 条未回放"
+                     % (len(conn.records) - conn.pos)))
+            sys.exit(1)
+        print("回放一致")
+        return
+
+    if opts.gang:
+        ports = expand_ports(opts.gang)
+        if not ports:
+            parser.error("no serial port matches %s" % " ".join(opts.gang))
+        if code is None:
+            parser.error("gang programming requires a code image")
+
+        print("通信端口：%s  最低波特率：%d bps"
+              % (" ".join(ports), opts.lowbaud))
+        results = gang_program(ports, code, opts, checksums)
+        print_gang_results(results)
+        if not all(r.ok for r in results):
+            sys.exit(1)
+        return
+
     print("通信端口：%s  最低波特率：%d bps" % (opts.port, opts.lowbaud))
     
-    global highbaud_pre
-    highbaud_pre = opts.highbaud
     with serial.Serial(port=opts.port,
                        baudrate=opts.lowbaud,
                        parity=serial.PARITY_NONE) as conn:
+        transport = SerialTransport(conn)
+
+        if command == "calibrate":
+            if not opts.timing_profile:
+                parser.error("calibrate needs --timing-profile FILE")
+            calibrate(transport, code or BLANK_BLOCK * 4, opts,
+                      opts.calibrate_runs)
+            return
+
+        handshake_cache = (HandshakeCache(opts.handshake_cache)
+                           if opts.handshake_cache else None)
+
+        if opts.loop:
+            production_loop(transport, code, opts, handshake_cache, checksums)
+            return
+
         if opts.aispmagic:
-            autoisp(conn, opts.aispbaud, opts.aispmagic)
-        program(Programmer(conn, opts.protocol), code, opts.erase_eeprom)
+            run_sync(autoisp_async(transport, opts.aispbaud, opts.aispmagic,
+                                   opts.timing.get(opts.protocol,
+                                                   "autoisp")))
+        prog = make_programmer(transport, opts, opts.port, handshake_cache)
+        run_sync(program_async(prog, code, opts.erase_eeprom, opts.sparse,
+                               Throttle(ConsoleReport()), checksums))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,195 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stcemu
+import stcflash
+
+
+# Fits the smallest emulated flash and does not end in 0xFF, which the
+# emulator cannot tell from erased flash
+CODE = bytes(bytearray(range(255))) * 8
+
+FAMILIES = ["89", "12c5a", "12c52", "12cx052", "15", "8"]
+
+# Recorded by running this file as a script
+SESSIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions")
+
+
+def hex_record(addr, kind, data=b""):
+    rec = bytearray([len(data), addr >> 8, addr & 0xFF, kind]) + data
+    rec.append(-sum(rec) & 0xFF)
+    return b":" + stcflash.hexstr(rec).replace(" ", "").encode("ascii")
+
+
+@pytest.mark.parametrize("protocol", FAMILIES)
+def test_program(protocol):
+    with stcemu.Target(protocol) as target:
+        with target.connect() as conn:
+            result = stcflash.program_device(conn, CODE, verify=True,
+                                             detect_timeout=5)
+    assert result.ok, result.error
+    assert target.image() == CODE
+    assert len(target.sessions) == 1
+
+
+def test_resume_after_reset():
+    with stcemu.Target("8", reset_at=1024) as target:
+        with target.connect() as conn:
+            events = []
+            result = stcflash.program_device(conn, CODE, events.append,
+                                             resume=1, detect_timeout=5)
+    assert result.ok, result.error
+    assert stcflash.ResumeEvent(1024) in events
+    assert target.image() == CODE
+
+
+@pytest.mark.parametrize("protocol", ["12c5a", "8"])
+def test_block_retry_after_write_errors(protocol):
+    with stcemu.Target(protocol,
+                       write_errors=stcflash.BLOCK_RETRIES) as target:
+        with target.connect() as conn:
+            result = stcflash.program_device(conn, CODE, verify=True,
+                                             detect_timeout=5)
+    assert result.ok, result.error
+    assert target.image() == CODE
+
+
+@pytest.mark.parametrize("protocol", ["12c5a", "8"])
+def test_block_retry_after_lost_reply(protocol):
+    with stcemu.Target(protocol, lost_replies=1) as target:
+        with target.connect() as conn:
+            result = stcflash.program_device(conn, CODE, verify=True,
+                                             detect_timeout=5)
+    assert result.ok, result.error
+    assert target.image() == CODE
+
+
+@pytest.mark.parametrize("protocol", ["12c5a", "8"])
+def test_block_fails_after_retries(protocol):
+    # A block that never verifies is not resumed: the chip is still in
+    # its session and the block cannot be written again without an erase
+    with stcemu.Target(protocol,
+                       write_errors=stcflash.BLOCK_RETRIES + 1) as target:
+        with target.connect() as conn:
+            events = []
+            result = stcflash.program_device(conn, CODE, events.append,
+                                             verify=True, resume=1,
+                                             detect_timeout=5)
+    assert not result.ok
+    assert result.error == "校验失败: 0000"
+    assert not [e for e in events if isinstance(e, stcflash.ResumeEvent)]
+
+
+def session_path(protocol):
+    return os.path.join(SESSIONS, "stc%s.rec" % protocol)
+
+
+def record_session(protocol):
+    opts = stcflash.job_options({"protocol": protocol, "verify": True})
+    opts.record = session_path(protocol)
+    with stcemu.Target(protocol) as target:
+        with target.connect() as conn:
+            result = stcflash.run_sync(stcflash.program_job(
+                target.port, stcflash.SerialTransport(conn), CODE, opts,
+                checksums=stcflash.block_checksums(CODE)))
+    assert result.ok, result.error
+
+
+@pytest.mark.parametrize("protocol", FAMILIES)
+def test_replay(protocol):
+    result, conn = stcflash.replay_session(session_path(protocol), CODE)
+    assert result.ok, result.error
+    assert conn.error is None
+    assert conn.finished()
+
+
+def test_replay_catches_changed_image():
+    code = bytearray(CODE)
+    code[1000] ^= 1
+    result, conn = stcflash.replay_session(session_path("8"), code)
+    assert not result.ok
+    assert conn.error is not None
+
+
+def test_frame_parser_resync():
+    encoder = stcflash.FrameEncoder()
+    good = bytes(encoder.encode(0x05, [0x00, 0x00, 0x5A, 0xA5], chkmode=2))
+    bad = bytearray(good)
+    bad[-2] ^= 0xFF
+
+    parser = stcflash.FrameParser()
+    marker = [0x46, 0xB9, 0x6A]
+    parser.feed(b"\x00\x46\xB9" + bytes(bad) + good[:7])
+    assert parser.next(marker, 2) is None
+    parser.feed(good[7:])
+    assert parser.next(marker, 2) == (0x05, [0x00, 0x00, 0x5A, 0xA5])
+    assert parser.next(marker, 2) is None
+
+
+def test_parse_hex_merges_segments():
+    source = b"\n".join([
+        hex_record(0x0000, 0, b"\xAA\xAA"),
+        hex_record(0x0002, 0, b"\xBB\xBB\xBB"),
+        hex_record(0x0100, 0, b"\xDD"),
+        hex_record(0x0001, 0, b"\xCC\xCC"),
+        hex_record(0x0000, 5, b"\x00\x00\x00\x10"),
+        hex_record(0x0000, 1),
+    ])
+    image = stcflash.parse_hex(source)
+    assert [(addr, bytes(data)) for addr, data in image.segments] == \
+        [(0x0000, b"\xAA\xCC\xCC\xBB\xBB"), (0x0100, b"\xDD")]
+    assert image.start == 0x10
+    assert len(image) == 0x101
+    assert bytes(image.flat()[5:0x100]) == b"\xFF" * (0x100 - 5)
+
+
+def test_parse_hex_rejects_bad_checksum():
+    rec = bytearray(hex_record(0x0000, 0, b"\xAA"))
+    rec[-1:] = b"0" if rec[-1:] != b"0" else b"1"
+    with pytest.raises(Exception):
+        stcflash.parse_hex(bytes(rec))
+
+
+def test_image_cache_checks_content(tmp_path):
+    path = tmp_path / "fw.hex"
+    cache = stcflash.ImageCache(str(tmp_path / "cache"))
+
+    def load():
+        with open(str(path), "rb") as f:
+            return bytes(stcflash.load_image(f, cache).flat())
+
+    path.write_bytes(hex_record(0, 0, b"\x01\x02") + b"\n"
+                     + hex_record(0, 1))
+    assert load() == b"\x01\x02"
+    assert load() == b"\x01\x02"
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    # Same size and mtime, different content
+    st = os.stat(str(path))
+    path.write_bytes(hex_record(0, 0, b"\x03\x04") + b"\n"
+                     + hex_record(0, 1))
+    os.utime(str(path), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert load() == b"\x03\x04"
+
+
+def test_overlay():
+    code = bytes(bytearray(range(256))) * 2
+    blocks = stcflash.overlay(code, 0x7E, b"\x01\x02\x03\x04")
+    assert sorted(blocks) == [0x00, 0x80]
+    assert blocks[0x00] == code[:0x7E] + b"\x01\x02"
+    assert blocks[0x80] == b"\x03\x04" + code[0x82:0x100]
+
+    # Past the end of the code the block is blank apart from the data
+    blocks = stcflash.overlay(code, 0x204, b"\x55")
+    assert blocks == {0x200: b"\xFF" * 4 + b"\x55" + b"\xFF" * 123}
+
+
+if __name__ == "__main__":
+    if not os.path.isdir(SESSIONS):
+        os.makedirs(SESSIONS)
+    for protocol in FAMILIES:
+        record_session(protocol)